@@ -0,0 +1,191 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+from lab4 import VFSRepl, OutputSink
+
+# Пресеты синтетических деревьев: ширина (поддиректорий на уровень), глубина,
+# файлов в каждой директории, диапазон размеров файлов и доля файлов-дубликатов
+PRESETS = {
+    'small': dict(breadth=3, depth=3, files=10, min_size=64, max_size=4 * 1024, duplicates=0.3),
+    'medium': dict(breadth=5, depth=4, files=20, min_size=64, max_size=16 * 1024, duplicates=0.5),
+    'large': dict(breadth=8, depth=4, files=40, min_size=64, max_size=64 * 1024, duplicates=0.7),
+}
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'error', 'warning', 'info', 'debug', 'request', 'response']
+
+def make_text(rng: random.Random, size: int) -> bytes:
+    # Текст с большим числом повторяющихся строк - типичный вход для uniq
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+        lines.append(line)
+        total += len(line) + 1
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def generate_tree(root: str, breadth: int, depth: int, files: int, min_size: int, max_size: int,
+                  duplicates: float, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    shared = [make_text(rng, rng.randint(min_size, max_size)) for _ in range(8)] # общие "вендорные" файлы
+    counts = {'dirs': 0, 'files': 0, 'bytes': 0}
+    pending = [(root, 0)]
+    while pending:
+        directory, level = pending.pop()
+        os.makedirs(directory, exist_ok=True)
+        counts['dirs'] += 1
+        for index in range(files):
+            if rng.random() < duplicates:
+                data = rng.choice(shared)
+            else:
+                # Размеры распределены логарифмически: много маленьких файлов и немного больших
+                size = int(min_size * (max_size / min_size) ** rng.random())
+                data = make_text(rng, size)
+            with open(os.path.join(directory, f'file_{index}.txt'), 'wb') as file:
+                file.write(data)
+            counts['files'] += 1
+            counts['bytes'] += len(data)
+        if level < depth:
+            pending.extend((os.path.join(directory, f'dir_{index}'), level + 1) for index in range(breadth))
+    return counts
+
+def make_repl(tree: str, **options) -> VFSRepl:
+    # Вывод команд уходит в память, чтобы не измерять скорость терминала
+    return VFSRepl(path=tree, out=OutputSink(io.StringIO()), **options)
+
+def measure(function, repeat: int, reset=None) -> list:
+    # reset (не замеряется) вызывается перед каждым повтором - для замеров "с холодными кэшами"
+    timings = []
+    for _ in range(repeat):
+        if reset is not None:
+            reset()
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def drop_caches(vfs):
+    # Сброс кэшей путей, содержимого и индексов строк, чтобы повторы не измеряли попадания в кэш
+    vfs.path_cache.clear()
+    vfs.root.reset_cached_paths()
+    vfs.content_cache.clear()
+    vfs.text_views.clear()
+
+def measure_cold_warm(results: dict, name: str, function, repeat: int, vfs):
+    # Холодный замер - после сброса кэшей, теплый - после прогрева тем же вызовом
+    results[name + '_cold'] = measure(function, repeat, lambda: drop_caches(vfs))
+    function()
+    results[name + '_warm'] = measure(function, repeat)
+
+def run_benchmarks(tree: str, repeat: int, lookups: int, options: dict) -> dict:
+    results = {}
+    results['load_from_disk'] = measure(lambda: make_repl(tree, **options), repeat)
+
+    repl = make_repl(tree, **options)
+    vfs = repl.vfs
+    nodes = list(vfs.root.iter_subtree())
+    rng = random.Random(1)
+    paths = [rng.choice(nodes).get_path() for _ in range(lookups)]
+    measure_cold_warm(results, 'find_node', lambda: [vfs.find_node(path) for path in paths], repeat, vfs)
+
+    directories = [node for node in nodes if node.is_directory]
+    widest = max(directories, key=lambda node: len(node.children))
+    widest_path = widest.get_path()
+    measure_cold_warm(results, 'cmd_ls', lambda: repl.cmd_ls([widest_path]), repeat, vfs)
+
+    def cd_walk():
+        for name, child in vfs.root.iter_children():
+            if child.is_directory:
+                repl.cmd_cd([name])
+                repl.cmd_cd(['..'])
+    results['cmd_cd'] = measure(cd_walk, repeat)
+
+    files = [node for node in nodes if not node.is_directory]
+    largest = max(files, key=lambda node: node.size)
+    largest_path = largest.get_path()
+    measure_cold_warm(results, 'cmd_uniq', lambda: repl.cmd_uniq([largest_path]), repeat, vfs)
+
+    rm_timings = []
+    for _ in range(repeat):
+        fresh = make_repl(tree, **options) # rm -r изменяет дерево, поэтому каждый запуск на новой копии
+        target = next(name for name, child in fresh.vfs.root.iter_children() if child.is_directory)
+        rm_timings.extend(measure(lambda: fresh.cmd_rm(['-r', '/' + target]), 1))
+    results['cmd_rm_r'] = rm_timings
+    return {'entries': len(nodes) - 1, 'timings': results}
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(previous_path: str, report: dict):
+    # Сравнение медиан с результатами другой ревизии: > 1.0 - стало медленнее
+    with open(previous_path) as file:
+        previous = json.load(file)
+    print(f"\nСравнение с ревизией {previous.get('revision')}:")
+    for size, data in report['results'].items():
+        old = previous.get('results', {}).get(size)
+        if not old:
+            continue
+        for operation, stats in data['operations'].items():
+            old_stats = old['operations'].get(operation)
+            if old_stats and old_stats['median'] > 0:
+                ratio = stats['median'] / old_stats['median']
+                print(f"  {size:8} {operation:16} {ratio:6.2f}x")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарки VFS на синтетических деревьях')
+    parser.add_argument('--sizes', default='small,medium', help='Пресеты через запятую: ' + ', '.join(PRESETS))
+    parser.add_argument('--repeat', type=int, default=5, help='Число повторов каждой операции')
+    parser.add_argument('--lookups', type=int, default=10000, help='Число вызовов find_node за один замер')
+    parser.add_argument('--lazy', action='store_true', help='Загружать VFS в ленивом режиме')
+    parser.add_argument('--load-workers', type=int, help='Число потоков загрузки')
+    parser.add_argument('--workdir', help='Где создавать деревья (по умолчанию - временная директория)')
+    parser.add_argument('--output', default='bench_results.json', help='Файл с результатами в формате JSON')
+    parser.add_argument('--compare', help='JSON с результатами другой ревизии для сравнения')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    options = {'lazy': args.lazy}
+    if args.load_workers:
+        options['load_workers'] = args.load_workers
+    workdir = args.workdir or tempfile.mkdtemp(prefix='vfs_bench_')
+    report = {'revision': git_revision(), 'python': platform.python_version(),
+              'options': options, 'repeat': args.repeat, 'results': {}}
+    try:
+        for size in args.sizes.split(','):
+            tree = os.path.join(workdir, size)
+            shutil.rmtree(tree, ignore_errors=True)
+            counts = generate_tree(tree, **PRESETS[size])
+            measured = run_benchmarks(tree, args.repeat, args.lookups, options)
+            operations = {operation: {'median': statistics.median(timings), 'min': min(timings), 'runs': timings}
+                          for operation, timings in measured['timings'].items()}
+            report['results'][size] = {'tree': counts, 'entries': measured['entries'], 'operations': operations}
+            print(f"{size}: {measured['entries']} объектов, {counts['bytes']} байт")
+            for operation, stats in operations.items():
+                print(f"  {operation:16} median {stats['median'] * 1000:9.3f} мс   min {stats['min'] * 1000:9.3f} мс")
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Результаты сохранены в {args.output}")
+    if args.compare:
+        compare(args.compare, report)
+
+if __name__ == "__main__":
+    main()
+
+# python3 bench_lab4.py --sizes small,medium --output bench_results.json - запуск
@@ -1,43 +1,984 @@
 import argparse
+import asyncio
+import bisect
+import codecs
+import copy
+import cProfile
+import fnmatch
 import getpass
+import hashlib
+import io
+import json
+import mmap
 import os
+import pstats
+import re
+import struct
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
+from types import MappingProxyType
 from typing import Dict, List, Optional
 
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024 # лимит кэша содержимого в ленивом режиме (байт)
+DEFAULT_MMAP_THRESHOLD = 16 * 1024 * 1024 # файлы от этого размера отображаются в память через mmap
+LATENCY_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0) # границы корзин гистограммы времени команд (с)
+OUTPUT_BUFFER_LIMIT = 64 * 1024 # сколько символов копится в буфере вывода до сброса в поток
+DEFAULT_LOAD_WORKERS = min(8, os.cpu_count() or 1) # потоки для параллельного сканирования директорий
+PATH_CACHE_LIMIT = 65536 # максимум записей в кэше путь -> узел
+DEFAULT_GREP_WORKERS = os.cpu_count() or 1 # процессы для grep по большим поддеревьям
+GREP_PARALLEL_MIN_BYTES = 8 * 1024 * 1024 # поддерево меньше этого ищется в текущем процессе
+GREP_CHUNK_BYTES = 4 * 1024 * 1024 # сколько байт файлов отдается процессу одной задачей
+GLOB_CACHE_LIMIT = 1024 # максимум скомпилированных шаблонов glob
+JOURNAL_BATCH = 256 # сколько записей журнала копится в памяти до записи на диск
+JOURNAL_COMPACT_MIN = 1024 # журнал короче этого не сжимается
+
+# Формат образа VFS: заголовок | содержимое файлов подряд | имена подряд | таблица узлов
+IMAGE_MAGIC = b'VFSIMG1\0'
+IMAGE_HEADER = struct.Struct('<8sQQQ') # сигнатура, число узлов, смещение имен, смещение таблицы
+# родитель, смещение имени, длина имени, флаги, смещение содержимого, длина содержимого, mtime
+IMAGE_RECORD = struct.Struct('<IQHBQQd')
+IMAGE_NO_PARENT = 0xFFFFFFFF
+IMAGE_FLAG_DIRECTORY = 1
+
+LINE_BREAK = re.compile(rb'\r\n|\r|\n')
+WORD = re.compile(rb'\S+')
+DEFAULT_HEAD_LINES = 10 # сколько строк по умолчанию выводят head и tail
+
+def iter_lines(buffer):
+    # Построчный обход буфера (bytes или mmap) без декодирования и копирования всего файла
+    position = 0
+    for match in LINE_BREAK.finditer(buffer):
+        yield buffer[position:match.start()]
+        position = match.end()
+    if position < len(buffer):
+        yield buffer[position:]
+
+def line_digest(line) -> bytes:
+    # Вместо самих строк храним 16-байтовые хэши - память не зависит от длины строк
+    return hashlib.blake2b(line, digest_size=16).digest()
+
+def decode_line(line) -> str:
+    # str(..., encoding) принимает любой буфер: bytes, срез mmap или memoryview
+    try:
+        return str(line, 'utf-8')
+    except UnicodeDecodeError:
+        return str(line, 'latin-1')
+
+def flag_count(args: List[str]) -> int:
+    # Длина ведущей серии флагов: до первого позиционного аргумента, "--" завершает серию и входит в нее
+    for index, arg in enumerate(args):
+        if arg == '--':
+            return index + 1
+        if not arg.startswith('-') or len(arg) == 1:
+            return index
+    return len(args)
+
+def split_flags(args: List[str]) -> tuple:
+    # Однобуквенные флаги ведущей серии (в т.ч. слитные: -cd) и позиционные аргументы.
+    # Аргументы после первого позиционного (или после "--") - не флаги, даже если начинаются с '-'
+    count = flag_count(args)
+    flags = set()
+    for arg in args[:count]:
+        if arg != '--':
+            flags.update(arg[1:])
+    return flags, args[count:]
+
+def detect_encoding(buffer) -> str:
+    # Кодировка всего файла: UTF-8, если он целиком корректен, иначе Latin-1 (строки такого файла
+    # декодируются по отдельности через decode_line - корректные UTF-8 строки не искажаются).
+    # Проверка идет кусками по 1 МБ, строка со всем содержимым не создается
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for start in range(0, len(buffer), 1 << 20):
+            decoder.decode(buffer[start:start + (1 << 20)])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf-8'
+
+class TextView:
+    # Текстовое представление файла: кодировка и индекс начал строк. Строится один раз за O(размера файла).
+    # Индекс хранит начало каждой step-й строки: для обычных файлов step = 1, а если полный индекс
+    # не помещается в limit байт, шаг удваивается - строка ищется от ближайшей контрольной точки
+    __slots__ = ('encoding', 'offsets', 'step', 'line_count', 'size', 'words')
+
+    def __init__(self, buffer, limit: int):
+        self.encoding = detect_encoding(buffer)
+        self.size = len(buffer)
+        offsets = array('Q', [0])
+        step = 1
+        lines = 0
+        last_end = 0
+        for match in LINE_BREAK.finditer(buffer):
+            lines += 1
+            last_end = match.end()
+            if lines % step == 0:
+                offsets.append(last_end)
+                if len(offsets) * offsets.itemsize > limit:
+                    offsets = offsets[::2]
+                    step *= 2
+        self.offsets = offsets
+        self.step = step
+        self.line_count = lines + (1 if last_end < self.size else 0) # последняя строка без перевода строки
+        self.words: Optional[int] = None # считается при первом запросе (wc)
+
+    def __len__(self) -> int:
+        # Размер индекса в байтах - по нему TextView вытесняется из ContentCache
+        return self.offsets.itemsize * len(self.offsets)
+
+    def byte_range(self, first: int, last: int) -> tuple:
+        # Границы байт, покрывающие строки first..last-1 (от контрольной точки не позже first),
+        # и номер строки, с которой начинается этот диапазон
+        base_line = first - first % self.step
+        end_line = -(-last // self.step) * self.step
+        stop = self.size if end_line >= self.line_count else self.offsets[end_line // self.step]
+        return self.offsets[base_line // self.step], stop, base_line
+
+    def raw_lines(self, chunk, base_line: int, first: int, last: int):
+        # chunk начинается со строки base_line; выдаются строки first..last-1 без перевода строки
+        index = base_line
+        position = 0
+        for match in LINE_BREAK.finditer(chunk):
+            if index >= last:
+                return
+            if index >= first:
+                yield chunk[position:match.start()]
+            index += 1
+            position = match.end()
+        if first <= index < last and position < len(chunk):
+            yield chunk[position:]
+
+    def decode(self, line) -> str:
+        return str(line, 'utf-8') if self.encoding == 'utf-8' else decode_line(line)
+
+    def count_words(self, buffer) -> int:
+        if self.words is None:
+            self.words = sum(1 for _ in WORD.finditer(buffer))
+        return self.words
+
+class DiskSource:
+    # Источник содержимого файла на диске - читается только по требованию.
+    # Строка с путем директории общая для всех ее файлов, поэтому полный путь не хранится
+    __slots__ = ('directory', 'name', 'mapped')
+
+    def __init__(self, directory: str, name: str, mapped: bool = False):
+        self.directory = directory
+        self.name = name
+        self.mapped = mapped # большие файлы не копируются в память, а отображаются через mmap
+
+    @property
+    def disk_path(self) -> str:
+        return os.path.join(self.directory, self.name)
+
+    def read(self):
+        with open(self.disk_path, "rb") as file:
+            if not self.mapped:
+                return file.read()
+            if os.fstat(file.fileno()).st_size == 0: # пустой файл отобразить нельзя
+                return b''
+            # Страницы кэширует ОС, отображение живет, пока на него есть ссылки
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+class CommandStats:
+    # Счетчик вызовов одной команды и гистограмма времени выполнения
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, elapsed: float):
+        self.calls += 1
+        self.total_time += elapsed
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+class VFSStats:
+    # Встроенная инструментация: команды, прочитанные байты, обход путей, загрузка
+    def __init__(self):
+        self.commands: Dict[str, CommandStats] = {}
+        self.bytes_read = 0
+        self.find_calls = 0
+        self.find_cache_hits = 0
+        self.nodes_visited = 0 # шагов по компонентам пути в resolve_path
+        self.load_time = 0.0
+        self.load_entries = 0
+
+    def record_command(self, command: str, elapsed: float):
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.record(elapsed)
+
+class OutputSink:
+    # Единый буферизованный вывод команд: строки копятся в списке и пишутся в поток одним вызовом.
+    # Поток можно подменить (например, io.StringIO в тестах), без stream используется текущий sys.stdout
+    def __init__(self, stream=None, limit: int = OUTPUT_BUFFER_LIMIT):
+        self.stream = stream
+        self.limit = limit
+        self.parts: List[str] = []
+        self.pending = 0
+
+    def write(self, text: str):
+        self.parts.append(text)
+        self.pending += len(text)
+        if self.pending >= self.limit:
+            self.flush()
+
+    def line(self, text: str = ''):
+        self.write(text + '\n')
+
+    def flush(self):
+        stream = self.stream or sys.stdout
+        if self.parts:
+            stream.write(''.join(self.parts))
+            self.parts.clear()
+            self.pending = 0
+        stream.flush()
+
+class VFSImage:
+    # Открытый образ VFS: файл отображается в память целиком, содержимое берется срезами без копирования
+    def __init__(self, image_path: str):
+        with open(image_path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+class ImageSource:
+    # Содержимое файла внутри образа VFS
+    __slots__ = ('image', 'offset', 'length')
+
+    def __init__(self, image: VFSImage, offset: int, length: int):
+        self.image = image
+        self.offset = offset
+        self.length = length
+
+    def read(self):
+        return self.image.view[self.offset:self.offset + self.length]
+
+class ZipArchive:
+    # zip-архив как источник VFS: центральный каталог дает индекс, член читается по своему смещению
+    def __init__(self, archive_path: str):
+        self.archive = zipfile.ZipFile(archive_path)
+        self.lock = threading.Lock()
+
+    def members(self):
+        for info in self.archive.infolist():
+            yield info.filename, info.is_dir(), info.file_size, time.mktime(info.date_time + (0, 0, -1)), info
+
+    def read_member(self, info: zipfile.ZipInfo) -> bytes:
+        with self.lock:
+            return self.archive.read(info)
+
+class TarArchive:
+    # tar-архив: индекс строится из заголовков членов. В несжатом tar содержимое лежит
+    # по смещению offset_data и читается напрямую; сжатый поток допускает только чтение через tarfile
+    def __init__(self, archive_path: str):
+        self.archive = tarfile.open(archive_path)
+        self.lock = threading.Lock()
+        self.raw = None
+        if isinstance(self.archive.fileobj, io.BufferedReader): # архив без сжатия
+            self.raw = open(archive_path, "rb")
+
+    def members(self):
+        for member in self.archive.getmembers():
+            if member.isdir() or member.isfile():
+                yield member.name, member.isdir(), member.size, float(member.mtime), member
+
+    def read_member(self, member: tarfile.TarInfo) -> bytes:
+        with self.lock:
+            if self.raw is not None:
+                self.raw.seek(member.offset_data)
+                return self.raw.read(member.size)
+            return self.archive.extractfile(member).read()
+
+class ArchiveSource:
+    # Содержимое члена архива - читается только при обращении
+    __slots__ = ('archive', 'member')
+
+    def __init__(self, archive, member):
+        self.archive = archive
+        self.member = member
+
+    def read(self) -> bytes:
+        return self.archive.read_member(self.member)
+
+GREP_PATTERNS: Dict[bytes, "re.Pattern"] = {} # скомпилированные шаблоны grep (свои в каждом процессе)
+
+def grep_buffer(pattern: bytes, buffer, mode: str):
+    # Поиск по сырому буферу без разбиения на строки и декодирования: регулярное выражение
+    # ищет совпадение, строка вокруг него находится по ближайшим '\n'.
+    # mode: 'lines' - совпавшие строки, 'count' - их число, 'files' - есть ли совпадение
+    regex = GREP_PATTERNS.get(pattern)
+    if regex is None:
+        regex = GREP_PATTERNS[pattern] = re.compile(pattern, re.MULTILINE)
+    if isinstance(buffer, memoryview): # у memoryview нет find/rfind
+        buffer = buffer.tobytes()
+    lines = []
+    count = 0
+    position = 0
+    size = len(buffer)
+    while position < size:
+        match = regex.search(buffer, position)
+        if match is None or (match.start() == size and buffer[size - 1] == 10): # за последним '\n' строки нет
+            break
+        count += 1
+        if mode == 'files':
+            break
+        end = buffer.find(b'\n', match.start())
+        if end < 0:
+            end = size
+        if mode == 'lines':
+            lines.append(bytes(buffer[buffer.rfind(b'\n', 0, match.start()) + 1:end]))
+        position = end + 1
+    return lines if mode == 'lines' else count
+
+def grep_chunk(pattern: bytes, mode: str, jobs: list) -> list:
+    # Задача для процесса пула: файл передается путем на диске (процесс читает его сам) или байтами
+    results = []
+    for job in jobs:
+        if isinstance(job, str):
+            try:
+                with open(job, 'rb') as file:
+                    job = file.read()
+            except OSError:
+                job = b''
+        results.append(grep_buffer(pattern, job, mode))
+    return results
+
+def open_archive(archive_path: str):
+    if zipfile.is_zipfile(archive_path):
+        return ZipArchive(archive_path)
+    if tarfile.is_tarfile(archive_path):
+        return TarArchive(archive_path)
+    return None
+
+class BlobStore:
+    # Хранилище содержимого с адресацией по хэшу: одинаковые файлы ссылаются на один объект bytes
+    def __init__(self):
+        self.blobs: Dict[bytes, bytes] = {} # хэш -> содержимое
+        self.refs: Dict[int, list] = {} # id(содержимого) -> [хэш, число ссылающихся узлов]
+        self.resident_bytes = 0
+
+    def intern(self, data: bytes) -> bytes:
+        digest = hashlib.blake2b(data, digest_size=32).digest()
+        blob = self.blobs.get(digest)
+        if blob is None:
+            blob = data
+            self.blobs[digest] = blob
+            self.refs[id(blob)] = [digest, 0]
+            self.resident_bytes += len(blob)
+        self.refs[id(blob)][1] += 1
+        return blob
+
+    def release(self, blob: bytes):
+        entry = self.refs.get(id(blob))
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] == 0: # последний узел с таким содержимым удален
+            del self.refs[id(blob)]
+            del self.blobs[entry[0]]
+            self.resident_bytes -= len(blob)
+
+class ContentCache:
+    # LRU-кэш содержимого файлов, ограниченный суммарным размером в байтах
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries: "OrderedDict[VFSNode, bytes]" = OrderedDict()
+
+    def get(self, node: 'VFSNode') -> Optional[bytes]:
+        data = self.entries.get(node)
+        if data is not None:
+            self.entries.move_to_end(node)
+        return data
+
+    def put(self, node: 'VFSNode', data: bytes):
+        if len(data) > self.max_bytes: # слишком большой файл не кэшируем
+            return
+        self.discard(node)
+        self.entries[node] = data
+        self.used_bytes += len(data)
+        while self.used_bytes > self.max_bytes: # вытесняем самые "холодные" файлы
+            _, old_data = self.entries.popitem(last=False)
+            self.used_bytes -= len(old_data)
+
+    def discard(self, node: 'VFSNode'):
+        data = self.entries.pop(node, None)
+        if data is not None:
+            self.used_bytes -= len(data)
+
+    def clear(self):
+        self.entries.clear()
+        self.used_bytes = 0
+
+NO_CHILDREN = MappingProxyType({}) # общий неизменяемый "словарь детей" для всех файлов
+
 class VFSNode:
-    def __init__(self, vfs_name: str, is_directory: bool=False, parent: Optional["VFSNode"] = None, content=None): 
-        self.vfs_name = vfs_name
+    # __slots__ убирает __dict__ у каждого узла - на больших деревьях это основная часть памяти
+    __slots__ = ('vfs_name', 'is_directory', 'children', 'parent', 'content', 'source', 'size', 'mtime',
+                 'cached_path', 'sorted_names', 'scanned', 'subtree_bytes', 'subtree_files', 'subtree_dirs')
+
+    def __init__(self, vfs_name: str, is_directory: bool=False, parent: Optional["VFSNode"] = None, content=None,
+                 source=None, size: int = 0, mtime: float = 0.0): 
+        self.vfs_name = sys.intern(vfs_name) # одинаковые имена в разных директориях хранятся один раз
         self.is_directory = is_directory
-        self.children: Dict[str, 'VFSNode'] = {}
+        self.children: Dict[str, 'VFSNode'] = {} if is_directory else NO_CHILDREN
+        # Имена детей в отсортированном порядке, поддерживаются в add_child/remove_child
+        self.sorted_names: Optional[List[str]] = [] if is_directory else None
+        self.scanned = True # False - директория создана загрузчиком, но ее содержимое еще не прочитано
         self.parent = parent
         self.content = content
+        self.source = source # откуда читать содержимое, если оно не загружено в память
+        self.size = size
+        self.mtime = mtime
+        self.cached_path: Optional[str] = None # вычисленный get_path(), пока узел не перемещен
+        # Агрегаты поддерева директории (без нее самой): байты файлов, число файлов и поддиректорий.
+        # Поддерживаются в add_child/remove_child подъемом до корня - O(глубины)
+        self.subtree_bytes = 0
+        self.subtree_files = 0
+        self.subtree_dirs = 0
+
+    def totals(self) -> tuple:
+        # Вклад узла в агрегаты родителя: (байты, файлы, директории)
+        if self.is_directory:
+            return self.subtree_bytes, self.subtree_files, self.subtree_dirs + 1
+        return self.size, 1, 0
+
+    def adjust_totals(self, size: int, files: int, dirs: int):
+        node = self
+        while node is not None:
+            node.subtree_bytes += size
+            node.subtree_files += files
+            node.subtree_dirs += dirs
+            node = node.parent
 
     def remove_child(self, child_name: str) -> bool:
-        if child_name in self.children:
+        child = self.children.get(child_name)
+        if child is not None:
             del self.children[child_name]
+            del self.sorted_names[bisect.bisect_left(self.sorted_names, child_name)]
+            size, files, dirs = child.totals()
+            self.adjust_totals(-size, -files, -dirs)
             return True
         return False
 
 
-    def add_child(self, child: 'VFSNode'):
-        self.children[child.vfs_name] =child
+    def add_child(self, child: 'VFSNode', propagate: bool = True):
+        # propagate=False - агрегаты пересчитает загрузчик одним проходом (attach_entries, rebuild_totals)
+        name = child.vfs_name
+        previous = self.children.get(name)
+        if previous is None:
+            names = self.sorted_names
+            if not names or names[-1] < name: # загрузчик добавляет детей уже по порядку
+                names.append(name)
+            else:
+                bisect.insort(names, name)
+        if propagate:
+            size, files, dirs = child.totals()
+            if previous is not None and previous is not child: # узел с тем же именем заменяется
+                old_size, old_files, old_dirs = previous.totals()
+                size, files, dirs = size - old_size, files - old_files, dirs - old_dirs
+            self.adjust_totals(size, files, dirs)
+        self.children[name] =child
+        if child.cached_path is not None: # узел переносится - пути его поддерева устарели
+            child.reset_cached_paths()
         child.parent = self
 
+    def iter_children(self, start: str = ''):
+        # Дети в порядке имен, начиная с первого имени >= start (без сортировки при каждом вызове)
+        names = self.sorted_names or []
+        for index in range(bisect.bisect_left(names, start) if start else 0, len(names)):
+            name = names[index]
+            yield name, self.children[name]
+
+    def iter_subtree(self):
+        # Обход поддерева (включая сам узел) без рекурсии
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    def is_inside(self, ancestor: 'VFSNode') -> bool:
+        current = self
+        while current is not None:
+            if current is ancestor:
+                return True
+            current = current.parent
+        return False
+
+    def reset_cached_paths(self):
+        # Путь кэшируется только если он закэширован у всех предков,
+        # поэтому обходим лишь ту часть поддерева, где кэш заполнен
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.cached_path = None
+            stack.extend(child for child in node.children.values() if child.cached_path is not None)
+
     def get_path(self) -> str:
-        path_parts=[]
+        if self.cached_path is not None:
+            return self.cached_path
+        # Поднимаемся до ближайшего предка с известным путем, затем кэшируем пути сверху вниз
+        chain = []
         current = self
-        while(current and current.vfs_name):
-            path_parts.append(current.vfs_name)
+        while current and current.vfs_name and current.cached_path is None:
+            chain.append(current)
             current = current.parent
-        return '/' + '/'.join(reversed(path_parts)) if path_parts else '/'
-        
-class VFS:
+        path = current.cached_path if current and current.vfs_name else ''
+        for node in reversed(chain):
+            path = path + '/' + node.vfs_name
+            node.cached_path = path
+        return path or '/'
+
+class Overlay:
+    # Слой изменений поверх неизменяемого базового дерева (copy-on-write): удаленные узлы только
+    # скрываются, поэтому снимок - это длина журнала, а откат стоит O(числа изменений)
+    def __init__(self):
+        self.hidden: set = set() # скрытые узлы (вместе с их поддеревьями)
+        self.log: List[VFSNode] = [] # скрытые узлы в порядке изменений
+        self.snapshots: List[int] = [] # длины журнала на момент снимков
+
+    def hide(self, node: VFSNode):
+        self.hidden.add(node)
+        self.log.append(node)
+
+    def snapshot(self) -> int:
+        self.snapshots.append(len(self.log))
+        return len(self.snapshots)
+
+    def rollback(self, number: Optional[int] = None) -> int:
+        # Откат к снимку number (по умолчанию - к последнему, без снимков - к базовому дереву)
+        if number is None:
+            number = len(self.snapshots)
+        mark = self.snapshots[number - 1] if number > 0 else 0
+        del self.snapshots[number:]
+        undone = 0
+        while len(self.log) > mark:
+            self.hidden.discard(self.log.pop())
+            undone += 1
+        return undone
+
+    def clear(self):
+        self.hidden.clear()
+        self.log.clear()
+        self.snapshots.clear()
+
+class Journal:
+    # Журнал изменений VFS: одна запись JSON на строку, только дописывание в конец.
+    # Записи копятся пачкой и пишутся одним write + fsync (на приглашении, при заполнении пачки, при выходе)
+    def __init__(self, journal_path: str, batch: int = JOURNAL_BATCH):
+        self.path = journal_path
+        self.batch = batch
+        self.pending: List[str] = []
+        self.records = 0 # записей в файле
+        self.valid_size = 0 # длина целых записей в начале файла
+        self.file = None
+
+    def read(self) -> List[list]:
+        # Недописанная последняя строка (обрыв при записи) отбрасывается
+        records = []
+        self.valid_size = 0
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'rb') as file:
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                self.valid_size += len(line)
+        return records
+
+    def open(self, records: int):
+        self.records = records
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if self.file.tell() > self.valid_size: # хвост оборванной записи отрезается до новых записей
+            self.file.truncate(self.valid_size)
+
+    def append(self, record: list):
+        self.pending.append(json.dumps(record) + '\n')
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending or self.file is None:
+            return
+        self.file.write(''.join(self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records += len(self.pending)
+        self.pending.clear()
+
+    def rewrite(self, records: List[list]):
+        # Сжатие: новое содержимое пишется во временный файл и атомарно подменяет журнал
+        self.pending.clear()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(''.join(json.dumps(record) + '\n' for record in records))
+            file.flush()
+            os.fsync(file.fileno())
+        if self.file is not None:
+            self.file.close()
+        os.replace(temp_path, self.path)
+        self.valid_size = os.path.getsize(self.path)
+        self.open(len(records))
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class LoadState:
+    # Состояние загрузки VFS. Сессии сервера получают копию VFS через copy.copy, но этот объект
+    # у них общий - окончание фоновой загрузки видно во всех сессиях
     def __init__(self):
-        self.root = VFSNode('', is_directory=True)
         self.loaded = False #загружена ли директория с диска
+        self.loading = False
+        self.load_started = 0.0
+        self.load_elapsed = 0.0
+        self.entries_loaded = 0
+        self.dirs_scanned = 0
+        self.dirs_pending = 0
+        self.load_errors: List[str] = []
+
+class VFS:
+    def __init__(self, lazy: bool = False, cache_size: int = DEFAULT_CACHE_SIZE,
+                 mmap_threshold: int = DEFAULT_MMAP_THRESHOLD, load_workers: int = DEFAULT_LOAD_WORKERS,
+                 dedup: bool = False, cow: bool = False, grep_workers: int = DEFAULT_GREP_WORKERS,
+                 out: Optional["OutputSink"] = None):
+        self.out = out or OutputSink()
+        self.stats = VFSStats()
+        self.root = VFSNode('', is_directory=True)
         self.current_dir = self.root
+        self.lazy = lazy # ленивый режим: содержимое файлов читается при первом обращении
+        self.content_cache = ContentCache(cache_size)
+        self.text_views = ContentCache(cache_size) # TextView файлов, сбрасываются вместе с содержимым
+        self.mmap_threshold = mmap_threshold # 0 - не использовать mmap
+        self.load_workers = load_workers
+        self.blob_store: Optional[BlobStore] = BlobStore() if dedup else None # дедупликация содержимого
+        self.disk_root: Optional[str] = None # физическая директория, из которой загружена VFS
+        # Фоновая загрузка: дерево меняется только под load_lock, команды REPL выполняются под ним же
+        self.load_lock = threading.RLock()
+        self.load_state = LoadState() # один объект на VFS и все ее сессии
+        self.read_only = False # сессии сервера разделяют базовое дерево и не могут его изменять
+        # Слой copy-on-write: rm скрывает узлы в нем, не трогая базовое дерево
+        self.overlay: Optional[Overlay] = Overlay() if cow else None
+        self.grep_workers = grep_workers
+        self.search_pool: List[ProcessPoolExecutor] = [] # пул процессов grep, создается при первом поиске
+        self.journal: Optional[Journal] = None # журнал изменений (--journal)
+        self.journal_removed: List[str] = [] # пути, удаленные из базового дерева с момента загрузки
+        # Глобальный индекс имен: имя -> множество узлов с этим именем (для find без обхода дерева)
+        self.name_index: Dict[str, set] = {}
+        self.detached: List[VFSNode] = [] # корни удаленных поддеревьев, ожидающие очистки
+        # Кэш разрешенных путей: абсолютный путь или (текущая директория, относительный путь) -> узел
+        self.path_cache: Dict[object, VFSNode] = {}
+        # Скомпилированные компоненты glob-шаблонов: компонент -> (буквальный префикс, регулярное выражение)
+        self.glob_cache: Dict[str, tuple] = {}
+
+    def fork_session(self, out: "OutputSink") -> "VFS":
+        # Сессия разделяет с этой VFS дерево, индексы и кэш содержимого, но имеет свою текущую
+        # директорию, вывод и слой изменений - сессии расходятся без копирования дерева
+        session = copy.copy(self)
+        session.current_dir = self.root
+        session.out = out
+        session.read_only = True
+        session.overlay = Overlay()
+        session.path_cache = {} # видимость узлов у каждой сессии своя
+        session.journal = None # изменения сессий живут только в их слоях
+        return session
+
+    def is_hidden(self, node: VFSNode) -> bool:
+        return self.overlay is not None and node in self.overlay.hidden
+
+    def child(self, node: VFSNode, name: str) -> Optional[VFSNode]:
+        found = node.children.get(name)
+        if found is None or self.is_hidden(found):
+            return None
+        return found
+
+    def iter_children(self, node: VFSNode, start: str = ''):
+        # Дети узла в порядке имен без скрытых слоем изменений
+        if self.overlay is None or not self.overlay.hidden:
+            return node.iter_children(start)
+        hidden = self.overlay.hidden
+        return ((name, child) for name, child in node.iter_children(start) if child not in hidden)
+
+    def children_with_prefix(self, node: VFSNode, prefix: str):
+        # Видимые дети, имена которых начинаются с prefix: бинарный поиск и проход до конца диапазона
+        for name, child in self.iter_children(node, prefix):
+            if not name.startswith(prefix):
+                break
+            yield name, child
+
+    def walk(self, start: VFSNode):
+        # Обход видимого поддерева без рекурсии (скрытые узлы пропускаются вместе с поддеревом)
+        if self.overlay is None or not self.overlay.hidden:
+            yield from start.iter_subtree()
+            return
+        hidden = self.overlay.hidden
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(child for child in node.children.values() if child not in hidden)
+
+    def contains(self, start: VFSNode, node: VFSNode) -> bool:
+        # Узел лежит внутри start и ни он, ни его предки не скрыты
+        hidden = self.overlay.hidden if self.overlay is not None else ()
+        current = node
+        while current is not None:
+            if current in hidden:
+                return False
+            if current is start:
+                return True
+            current = current.parent
+        return False
+
+    def read_content(self, node: VFSNode) -> Optional[bytes]:
+        if node.content is not None:
+            return node.content
+        if node.source is None:
+            return None
+        data = self.content_cache.get(node)
+        if data is None:
+            data = node.source.read()
+            if isinstance(data, bytes): # отображенные файлы и образы кэширует ОС, их байты не копируются
+                self.stats.bytes_read += len(data)
+                self.content_cache.put(node, data)
+        return data
+
+    def read_range(self, node: VFSNode, start: int, stop: int):
+        # Часть содержимого файла: ленивый файл, которого нет в кэше, читается с диска только в этих границах
+        source = node.source
+        if (node.content is None and isinstance(source, DiskSource) and not source.mapped
+                and self.content_cache.get(node) is None):
+            with open(source.disk_path, "rb") as file:
+                file.seek(start)
+                data = file.read(stop - start)
+            self.stats.bytes_read += len(data)
+            return data
+        return (self.read_content(node) or b'')[start:stop]
+
+    def text_view(self, node: VFSNode) -> TextView:
+        view = self.text_views.get(node)
+        if view is None:
+            # Индекс одного файла не больше восьмой части кэша, иначе он разреживается
+            view = TextView(self.read_content(node) or b'', max(4096, self.text_views.max_bytes // 8))
+            self.text_views.put(node, view)
+        return view
+
+    def text_lines(self, node: VFSNode, view: TextView, first: int, last: int):
+        # Строки first..last-1 файла: после построения TextView - O(числа запрошенных строк * step)
+        first = max(0, min(first, view.line_count))
+        last = max(first, min(last, view.line_count))
+        if first == last:
+            return
+        start, stop, base_line = view.byte_range(first, last)
+        chunk = self.read_range(node, start, stop)
+        for line in view.raw_lines(chunk, base_line, first, last):
+            yield view.decode(line)
+
+    def is_mapped_size(self, size: int) -> bool:
+        return self.mmap_threshold > 0 and size >= self.mmap_threshold
 
     def find_node(self, path):
+        key = path if path.startswith('/') else (self.current_dir, path)
+        self.stats.find_calls += 1
+        node = self.path_cache.get(key)
+        if node is not None:
+            self.stats.find_cache_hits += 1
+        else:
+            node = self.resolve_path(path)
+            if node is not None:
+                if len(self.path_cache) >= PATH_CACHE_LIMIT:
+                    self.path_cache.clear()
+                self.path_cache[key] = node
+        return node
+
+    def attach(self, parent: VFSNode, child: VFSNode, propagate: bool = True):
+        # Единая точка добавления узла в дерево - здесь же пополняется индекс имен
+        parent.add_child(child, propagate)
+        self.name_index.setdefault(child.vfs_name, set()).add(child)
+
+    def detach(self, node: VFSNode) -> bool:
+        # Удаление узла: при слое изменений узел только скрывается, иначе отсоединяется от дерева
+        path = node.get_path()
+        if self.overlay is not None:
+            if node.parent is None or self.is_hidden(node):
+                return False
+            self.overlay.hide(node)
+            self.path_cache.clear()
+            if self.current_dir.is_inside(node): # скрытая директория не может оставаться текущей
+                self.current_dir = node.parent
+            self.journal_record('hide', path)
+            return True
+        if not self.detach_base(node):
+            return False
+        self.journal_removed.append(path)
+        self.journal_record('rm', path)
+        return True
+
+    def detach_base(self, node: VFSNode) -> bool:
+        # Единая точка удаления узла из базового дерева. Поддерево отсоединяется целиком за O(1):
+        # обход его узлов (индекс имен, хранилище содержимого, кэш) откладывается до collect_detached
+        parent = node.parent
+        if parent is None or not parent.remove_child(node.vfs_name):
+            return False
+        if self.current_dir.is_inside(node): # текущая директория удалена - переходим к родителю поддерева
+            self.current_dir = parent
+        node.parent = None # отсоединенные узлы не доходят до корня и не проходят проверку contains
+        parent.mtime = 0.0 # директория расходится с диском - reload перечислит ее заново
+        self.path_cache.clear()
+        self.detached.append(node)
+        return True
+
+    def commit_overlay(self) -> int:
+        # Перенос изменений слоя в базовое дерево. rm видит только видимые узлы, поэтому
+        # ни один узел журнала не лежит внутри поддерева, скрытого раньше него
+        overlay = self.overlay
+        paths = [node.get_path() for node in overlay.log]
+        applied = sum(1 for node in overlay.log if self.detach_base(node))
+        overlay.clear()
+        self.journal_removed.extend(paths)
+        self.journal_record('commit')
+        return applied
+
+    def snapshot(self) -> int:
+        self.journal_record('snapshot')
+        return self.overlay.snapshot()
+
+    def rollback(self, number: Optional[int] = None) -> int:
+        self.journal_record('rollback', number)
+        self.path_cache.clear()
+        return self.overlay.rollback(number)
+
+    def journal_record(self, *record):
+        if self.journal is not None:
+            self.journal.append(list(record))
+
+    def open_journal(self, journal_path: str):
+        # Восстановление: записи журнала применяются к только что загруженному дереву - O(размера журнала)
+        journal = Journal(journal_path)
+        started = time.perf_counter()
+        records = journal.read()
+        applied = 0
+        with self.load_lock:
+            for record in records:
+                applied += self.apply_journal_record(record)
+            self.journal = journal
+            journal.open(len(records))
+        if records:
+            elapsed = time.perf_counter() - started
+            self.out.line(f"Журнал '{journal_path}': применено {applied} из {len(records)} записей "
+                          f"за {elapsed:.3f} с")
+        self.compact_journal_if_needed()
+
+    def apply_journal_record(self, record: list) -> int:
+        operation = record[0]
+        if operation in ('hide', 'snapshot', 'rollback') and self.overlay is None:
+            self.overlay = Overlay() # журнал записан с --cow - слой восстанавливается вместе с ним
+        if operation in ('rm', 'hide'):
+            node = self.find_node(record[1])
+            if node is None or node.parent is None: # дерево на диске изменилось после записи
+                return 0
+            if operation == 'hide':
+                self.overlay.hide(node)
+                self.path_cache.clear()
+            else:
+                self.detach_base(node)
+                self.journal_removed.append(record[1])
+        elif operation == 'snapshot':
+            self.overlay.snapshot()
+        elif operation == 'rollback':
+            self.overlay.rollback(record[1])
+        elif operation == 'commit' and self.overlay is not None:
+            self.commit_overlay()
+        else:
+            return 0
+        return 1
+
+    def journal_state(self) -> List[list]:
+        # Минимальный журнал для текущего состояния: удаления из базы без вложенных в уже удаленные
+        # пути, затем журнал слоя изменений с отметками снимков
+        removed = set(self.journal_removed)
+        records = [['rm', path] for path in self.journal_removed
+                   if not any(path[:index] in removed for index in range(1, len(path)) if path[index] == '/')]
+        if self.overlay is not None:
+            marks = self.overlay.snapshots
+            position = 0
+            for index, node in enumerate(self.overlay.log):
+                while position < len(marks) and marks[position] == index:
+                    records.append(['snapshot'])
+                    position += 1
+                records.append(['hide', node.get_path()])
+            records.extend(['snapshot'] for _ in marks[position:])
+        return records
+
+    def compact_journal_if_needed(self):
+        journal = self.journal
+        if journal is None or journal.records + len(journal.pending) < JOURNAL_COMPACT_MIN:
+            return
+        live = len(self.journal_removed)
+        if self.overlay is not None:
+            live += len(self.overlay.log) + len(self.overlay.snapshots)
+        if journal.records + len(journal.pending) > 2 * live:
+            journal.rewrite(self.journal_state())
+
+    def flush_journal(self):
+        if self.journal is not None:
+            self.journal.flush()
+            self.compact_journal_if_needed()
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def collect_detached(self) -> int:
+        # Пакетная очистка всего, что было отсоединено после прошлого вызова
+        collected = 0
+        while self.detached:
+            for removed in self.detached.pop().iter_subtree():
+                collected += 1
+                self.content_cache.discard(removed)
+                self.text_views.discard(removed)
+                if self.blob_store is not None and removed.content is not None:
+                    self.blob_store.release(removed.content)
+                nodes = self.name_index.get(removed.vfs_name)
+                if nodes is not None:
+                    nodes.discard(removed)
+                    if not nodes:
+                        del self.name_index[removed.vfs_name]
+        return collected
+
+    def find(self, start: VFSNode, pattern: Optional[str] = None, node_type: Optional[str] = None) -> List[VFSNode]:
+        # С шаблоном имени кандидаты берутся из индекса, обход дерева нужен только без шаблона
+        self.collect_detached()
+        self.ensure_subtree_loaded(start)
+        if pattern is None:
+            candidates = self.walk(start)
+        elif not any(char in pattern for char in '*?['):
+            candidates = [node for node in self.name_index.get(pattern, ()) if self.contains(start, node)]
+        else:
+            regex = re.compile(fnmatch.translate(pattern))
+            candidates = [node for name, nodes in self.name_index.items() if regex.match(name)
+                          for node in nodes if self.contains(start, node)]
+        found = [node for node in candidates
+                 if node_type is None or node.is_directory == (node_type == 'd')]
+        found.sort(key=lambda node: node.get_path())
+        return found
+
+    def resolve_path(self, path):
         if path.startswith('/'):
             current = self.root
             path_parts = path[1:].split('/')
@@ -47,6 +988,7 @@ class VFS:
         
         # Убираем пустые части (если путь заканчивается на /)
         path_parts = [part for part in path_parts if part]
+        self.stats.nodes_visited += len(path_parts)
         
         for part in path_parts:
             if part == '..':
@@ -54,65 +996,665 @@ class VFS:
                     current = current.parent
             elif part == '.':
                 continue
-            elif part in current.children:
-                current = current.children[part]
             else:
-                return None
+                if not current.scanned: # фоновая загрузка еще не дошла до этой директории
+                    self.ensure_loaded(current)
+                current = self.child(current, part)
+                if current is None:
+                    return None
         
         return current
 
-    def load_from_disk(self, disk_path: str):
+    def grep(self, pattern: bytes, nodes: List[VFSNode], mode: str) -> list:
+        # Результат grep_buffer для каждого файла из nodes. Большие поддеревья делятся на задачи
+        # по GREP_CHUNK_BYTES и ищутся в пуле процессов: файлы с диска процесс читает сам,
+        # содержимое из памяти, образа или архива передается байтами
+        total = sum(node.size for node in nodes)
+        if self.grep_workers <= 1 or len(nodes) < 2 or total < GREP_PARALLEL_MIN_BYTES:
+            return [grep_buffer(pattern, self.read_content(node) or b'', mode) for node in nodes]
+        if not self.search_pool: # список общий у всех сессий сервера - пул тоже один
+            self.search_pool.append(ProcessPoolExecutor(max_workers=self.grep_workers))
+        chunks = []
+        jobs = []
+        chunk_bytes = 0
+        for node in nodes:
+            if node.content is None and isinstance(node.source, DiskSource):
+                jobs.append(node.source.disk_path)
+                self.stats.bytes_read += node.size
+            else:
+                data = self.read_content(node) or b''
+                jobs.append(data.tobytes() if isinstance(data, memoryview) else bytes(data))
+            chunk_bytes += node.size
+            if chunk_bytes >= GREP_CHUNK_BYTES:
+                chunks.append(jobs)
+                jobs = []
+                chunk_bytes = 0
+        if jobs:
+            chunks.append(jobs)
+        pool = self.search_pool[0]
+        futures = [pool.submit(grep_chunk, pattern, mode, chunk) for chunk in chunks]
+        return [result for future in futures for result in future.result()]
+
+    def compile_glob(self, component: str) -> tuple:
+        compiled = self.glob_cache.get(component)
+        if compiled is None:
+            # Буквальная часть до первого спецсимвола сужает перебор до диапазона в sorted_names
+            literal = re.match(r'[^*?\[]*', component).group()
+            compiled = (literal, re.compile(fnmatch.translate(component)).match)
+            if len(self.glob_cache) >= GLOB_CACHE_LIMIT:
+                self.glob_cache.clear()
+            self.glob_cache[component] = compiled
+        return compiled
+
+    def glob(self, pattern: str) -> List[str]:
+        # Раскрытие шаблона по дереву VFS покомпонентно: на каждом уровне шаблон сравнивается
+        # только с детьми, имена которых начинаются с его буквального префикса
+        if pattern.startswith('/'):
+            matches = [(self.root, '/')]
+        else:
+            matches = [(self.current_dir, '')]
+        components = [part for part in pattern.split('/') if part]
+        directories_only = pattern.endswith('/') # "*/" - только директории, как в shell
+        for position, component in enumerate(components):
+            last = position == len(components) - 1 and not directories_only
+            expanded = []
+            for node, prefix in matches:
+                if not node.is_directory:
+                    continue
+                self.ensure_loaded(node)
+                if not any(char in component for char in '*?['):
+                    if component == '..':
+                        found = node.parent or node
+                    elif component == '.':
+                        found = node
+                    else:
+                        found = self.child(node, component)
+                    if found is not None and (last or found.is_directory):
+                        expanded.append((found, prefix + component))
+                    continue
+                literal, match = self.compile_glob(component)
+                for name, child in self.children_with_prefix(node, literal):
+                    if name.startswith('.') and not literal.startswith('.'):
+                        continue # как в shell: скрытые имена совпадают только с явной точкой
+                    if match(name) and (last or child.is_directory):
+                        expanded.append((child, prefix + name))
+            matches = [(node, path if last else path + '/') for node, path in expanded]
+            if not matches:
+                return []
+        return [path for _, path in matches]
+
+    def load_from_disk(self, disk_path: str, background: bool = False):
         path_obj = Path(disk_path)
         if(not path_obj.exists()):
-            print("Путь не найден")
+            self.out.line("Путь не найден")
             return False
         if(not path_obj.is_dir()):
-            print("Путь не является директорией")
+            archive = open_archive(str(path_obj)) if path_obj.is_file() else None
+            if archive is not None:
+                return self.load_archive(archive, disk_path)
+            self.out.line("Путь не является директорией")
             return False
+        self.load_state.entries_loaded = 0
+        self.load_state.dirs_scanned = 0
+        self.load_state.load_errors = []
+        self.disk_root = str(path_obj)
+        self.root.mtime = path_obj.stat().st_mtime # до сканирования: изменения во время загрузки заметит reload
+        self.load_state.load_started = time.perf_counter()
+        self.root.scanned = False
+        if background:
+            # Приглашение появляется сразу, дерево достраивается в отдельном потоке
+            self.load_state.loading = True
+            threading.Thread(target=self.background_load, args=(path_obj,), daemon=True).start()
+            self.out.line(f"Загрузка VFS из '{disk_path}' запущена в фоне (команда status - прогресс)")
+            return True
         try:
             self.build_vfs_tree(self.root, path_obj)
-            self.loaded = True
-            print(f"VFS успешно загружена из '{disk_path}'")
+            self.finish_load()
+            self.out.line(f"VFS успешно загружена из '{disk_path}'")
+            rate = self.load_state.entries_loaded / self.load_state.load_elapsed if self.load_state.load_elapsed > 0 else 0
+            self.out.line(f"Загружено объектов: {self.load_state.entries_loaded} за {self.load_state.load_elapsed:.3f} с ({rate:.0f} объектов/с)")
             return True
         except Exception as error:
-            print("Ошибка - "+ error)
+            self.out.line(f"Ошибка - {error}")
             return False
-  
-    def build_vfs_tree(self, vfs_node: VFSNode, disk_path: Path):
+
+    def load_archive(self, archive, archive_path: str) -> bool:
+        # Дерево строится только по индексу членов архива, без распаковки содержимого
+        started = time.perf_counter()
+        self.load_state.entries_loaded = 0
+        directories: Dict[str, VFSNode] = {'': self.root}
         try:
-            for item in disk_path.iterdir():
-                if item.is_dir():
-                    dir_node = VFSNode(item.name, is_directory=True, parent = vfs_node)
-                    vfs_node.add_child(dir_node)
-                    self.build_vfs_tree(dir_node, item)
-                else:
-                    with open(item, "rb") as file:
-                        content = file.read()
-                    file_node = VFSNode(item.name, is_directory=False, parent= vfs_node, content = content)
-                    vfs_node.add_child(file_node)
+            for member_name, is_dir, size, mtime, member in archive.members():
+                parts = [part for part in member_name.split('/') if part and part not in ('.', '..')]
+                if not parts:
+                    continue
+                parent = self.root
+                for depth in range(len(parts) - 1): # промежуточные директории могут не иметь своих записей
+                    parent = self.archive_directory(directories, parts[:depth + 1], parent)
+                if is_dir:
+                    self.archive_directory(directories, parts, parent).mtime = mtime
+                elif parts[-1] not in parent.children:
+                    file_node = VFSNode(parts[-1], is_directory=False, parent=parent, size=size, mtime=mtime,
+                                        source=ArchiveSource(archive, member))
+                    self.attach(parent, file_node, propagate=False)
+                    self.load_state.entries_loaded += 1
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as error:
+            self.out.line(f"Ошибка чтения архива - {error}")
+            return False
+        self.rebuild_totals(self.root)
+        self.load_state.load_elapsed = time.perf_counter() - started
+        self.load_state.loaded = True
+        self.stats.load_time += self.load_state.load_elapsed
+        self.stats.load_entries += self.load_state.entries_loaded
+        self.out.line(f"VFS загружена из архива '{archive_path}': {self.load_state.entries_loaded} объектов за {self.load_state.load_elapsed:.3f} с")
+        return True
+
+    def rebuild_totals(self, start: VFSNode):
+        # Пересчет агрегатов поддерева одним проходом: iter_subtree выдает родителя раньше детей,
+        # поэтому в обратном порядке каждый узел добавляет к родителю уже готовый вклад
+        nodes = list(start.iter_subtree())
+        for node in nodes:
+            node.subtree_bytes = node.subtree_files = node.subtree_dirs = 0
+        for node in reversed(nodes[1:]):
+            size, files, dirs = node.totals()
+            node.parent.subtree_bytes += size
+            node.parent.subtree_files += files
+            node.parent.subtree_dirs += dirs
+
+    def archive_directory(self, directories: Dict[str, VFSNode], parts: List[str], parent: VFSNode) -> VFSNode:
+        key = '/'.join(parts)
+        node = directories.get(key)
+        if node is None:
+            node = VFSNode(parts[-1], is_directory=True, parent=parent)
+            self.attach(parent, node, propagate=False)
+            directories[key] = node
+            self.load_state.entries_loaded += 1
+        return node
+
+    def background_load(self, path_obj: Path):
+        try:
+            self.build_vfs_tree(self.root, path_obj)
         except Exception as error:
-            print("Ошибка - " + error)
+            self.load_state.load_errors.append(str(error))
+        with self.load_lock:
+            self.finish_load()
+            self.load_state.loading = False
+
+    def finish_load(self):
+        self.load_state.load_elapsed = time.perf_counter() - self.load_state.load_started
+        self.load_state.loaded = True
+        self.stats.load_time += self.load_state.load_elapsed
+        self.stats.load_entries += self.load_state.entries_loaded
+
+    def report_load_error(self, error: Exception):
+        # Из фонового потока в общий вывод не пишем - ошибки показывает команда status
+        if self.load_state.loading:
+            self.load_state.load_errors.append(str(error))
+        else:
+            self.out.line(f"Ошибка - {error}")
+
+    def node_disk_path(self, node: VFSNode) -> str:
+        return os.path.join(self.disk_root, node.get_path().lstrip('/'))
+
+    def ensure_loaded(self, node: VFSNode):
+        # Директория, до которой фоновый загрузчик еще не дошел, читается сразу в текущем потоке
+        if node.scanned or not node.is_directory or self.disk_root is None:
+            return
+        with self.load_lock:
+            if node.scanned:
+                return
+            path = self.node_disk_path(node)
+            try:
+                entries = self.scan_directory(path)
+            except OSError as error:
+                self.out.line(f"Ошибка - {error}")
+                entries = []
+            self.attach_scanned(node, path, entries)
+
+    def ensure_subtree_loaded(self, node: VFSNode):
+        # Для команд, которым нужно все поддерево: догружаем только его, не дожидаясь всей VFS
+        if not self.load_state.loading:
+            return
+        pending = deque([node])
+        while pending:
+            current = pending.popleft()
+            self.ensure_loaded(current)
+            pending.extend(child for child in current.children.values() if child.is_directory)
+
+    def scan_directory(self, disk_path: str) -> list:
+        # Чтение одной директории через os.scandir: тип и stat берутся из записи каталога.
+        # Выполняется в потоках пула, поэтому только читает диск и не трогает дерево VFS
+        with os.scandir(disk_path) as iterator:
+            entries = [scanned for scanned in map(self.scan_entry, iterator) if scanned is not None]
+        entries.sort(key=lambda entry: entry[0]) # порядок не зависит от ФС и от порядка завершения потоков
+        return entries
+
+    def scan_entry(self, entry: os.DirEntry) -> Optional[tuple]:
+        # Ошибка одной записи (битая ссылка, нечитаемый файл) пропускает только ее, а не всю директорию
+        try:
+            if entry.is_dir():
+                return (entry.name, True, 0, entry.stat().st_mtime, None)
+            stat = entry.stat()
+            content = None
+            if not (self.lazy or self.is_mapped_size(stat.st_size)):
+                with open(entry.path, "rb") as file:
+                    content = file.read()
+            return (entry.name, False, stat.st_size, stat.st_mtime, content)
+        except OSError as error:
+            self.report_load_error(error)
+            return None
+
+    def attach_entries(self, vfs_node: VFSNode, disk_dir: str, entries: list) -> list:
+        # Создание узлов по результату scan_directory, возвращает поддиректории для дальнейшего обхода
+        # Агрегаты предков обновляются одним подъемом на всю директорию, а не на каждый узел
+        subdirs = []
+        total_bytes = 0
+        for name, is_dir, size, mtime, content in entries:
+            if is_dir:
+                dir_node = VFSNode(name, is_directory=True, parent = vfs_node, mtime=mtime)
+                dir_node.scanned = False
+                self.attach(vfs_node, dir_node, propagate=False)
+                subdirs.append((dir_node, os.path.join(disk_dir, name)))
+            elif content is None:
+                # Сохраняем только путь и метаданные, без чтения файла
+                file_node = VFSNode(name, is_directory=False, parent= vfs_node, size=size, mtime=mtime)
+                file_node.source = DiskSource(disk_dir, file_node.vfs_name, self.is_mapped_size(size))
+                self.attach(vfs_node, file_node, propagate=False)
+            else:
+                self.stats.bytes_read += len(content) # содержимое прочитано в scan_entry (в т.ч. в потоках пула)
+                if self.blob_store is not None:
+                    content = self.blob_store.intern(content)
+                file_node = VFSNode(name, is_directory=False, parent= vfs_node, content = content,
+                                    size=size, mtime=mtime)
+                self.attach(vfs_node, file_node, propagate=False)
+            total_bytes += size
+        vfs_node.adjust_totals(total_bytes, len(entries) - len(subdirs), len(subdirs))
+        self.load_state.entries_loaded += len(entries)
+        return subdirs
+
+    def reload_from_disk(self) -> Optional[Dict[str, int]]:
+        # Сверка дерева с диском: перечисляются только директории с изменившимся mtime (в них
+        # добавляли, удаляли или переименовывали записи), в остальных известные файлы проверяются через stat -
+        # запись в файл на месте не меняет mtime директории.
+        # Содержимое перечитывается у файлов с другим размером или mtime, новые поддеревья строятся с нуля.
+        # added/removed считают все узлы поддеревьев, а не только верхние записи
+        if self.disk_root is None:
+            return None
+        self.ensure_subtree_loaded(self.root)
+        changes = {'added': 0, 'removed': 0, 'updated': 0}
+        pending = deque([(self.root, self.disk_root)])
+        while pending:
+            node, path = pending.popleft()
+            try:
+                mtime = os.stat(path).st_mtime # до перечисления, чтобы не пропустить изменения во время сверки
+                if mtime != node.mtime:
+                    with os.scandir(path) as iterator:
+                        disk_entries = {entry.name: entry for entry in iterator}
+            except OSError as error:
+                self.out.line(f"Ошибка - {error}")
+                continue
+            if mtime == node.mtime: # набор имен не менялся - только stat известных файлов
+                for name, child in list(node.children.items()):
+                    if child.is_directory:
+                        pending.append((child, os.path.join(path, name)))
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(path, name))
+                    except OSError as error:
+                        self.out.line(f"Ошибка - {error}")
+                        continue
+                    if stat.st_size != child.size or stat.st_mtime != child.mtime:
+                        self.refresh_file(child, path, stat)
+                        changes['updated'] += 1
+                continue
+            for name, child in list(node.children.items()):
+                entry = disk_entries.get(name)
+                if entry is None or entry.is_dir() != child.is_directory:
+                    # Удален с диска или сменил тип - во втором случае будет добавлен заново ниже
+                    _, files, dirs = child.totals()
+                    self.detach_base(child)
+                    changes['removed'] += files + dirs
+                    continue
+                del disk_entries[name]
+                if child.is_directory:
+                    pending.append((child, entry.path))
+                    continue
+                stat = entry.stat()
+                if stat.st_size != child.size or stat.st_mtime != child.mtime:
+                    self.refresh_file(child, path, stat)
+                    changes['updated'] += 1
+            if disk_entries:
+                new_entries = sorted((scanned for scanned in map(self.scan_entry, disk_entries.values())
+                                      if scanned is not None), key=lambda entry: entry[0])
+                for dir_node, dir_path in self.attach_entries(node, path, new_entries):
+                    self.build_vfs_tree(dir_node, Path(dir_path))
+                for name, *_ in new_entries:
+                    _, files, dirs = node.children[name].totals()
+                    changes['added'] += files + dirs
+            node.mtime = mtime # после detach_base, который сбрасывает mtime родителя
+        # Дерево снова совпадает с диском - прежние удаления из журнала больше не действуют
+        self.journal_removed.clear()
+        if self.journal is not None:
+            self.journal.rewrite(self.journal_state())
+        return changes
+
+    def refresh_file(self, node: VFSNode, disk_dir: str, stat: os.stat_result):
+        self.content_cache.discard(node)
+        self.text_views.discard(node)
+        if self.blob_store is not None and node.content is not None:
+            self.blob_store.release(node.content)
+        node.parent.adjust_totals(stat.st_size - node.size, 0, 0)
+        node.size = stat.st_size
+        node.mtime = stat.st_mtime
+        mapped = self.is_mapped_size(stat.st_size)
+        if self.lazy or mapped:
+            node.content = None
+            node.source = DiskSource(disk_dir, node.vfs_name, mapped)
+        else:
+            node.source = None
+            with open(os.path.join(disk_dir, node.vfs_name), "rb") as file:
+                node.content = file.read()
+            self.stats.bytes_read += len(node.content)
+            if self.blob_store is not None:
+                node.content = self.blob_store.intern(node.content)
+
+    def subtree_totals(self, start: VFSNode) -> tuple:
+        # (байты, файлы, директории включая start) из агрегатов - O(глубины) без обхода поддерева.
+        # Узлы, скрытые слоем изменений, вычитаются: O(скрытых узлов * глубины)
+        self.ensure_subtree_loaded(start)
+        size, files, dirs = start.totals()
+        hidden = self.overlay.hidden if self.overlay is not None else ()
+        for node in hidden:
+            current = node.parent
+            while current is not None and current is not start and current not in hidden:
+                current = current.parent
+            if current is start: # внутри start и не вложен в другой скрытый узел
+                hidden_size, hidden_files, hidden_dirs = node.totals()
+                size, files, dirs = size - hidden_size, files - hidden_files, dirs - hidden_dirs
+        return size, files, dirs
+
+    def disk_usage(self, start: VFSNode) -> Dict[str, int]:
+        # Логический размер - сумма размеров файлов, резидентный - уникальное содержимое в памяти
+        self.collect_detached()
+        self.ensure_subtree_loaded(start)
+        usage = {'files': 0, 'dirs': 0, 'logical': 0, 'resident': 0}
+        seen = set()
+        for node in self.walk(start):
+            if node.is_directory:
+                usage['dirs'] += 1
+                continue
+            usage['files'] += 1
+            usage['logical'] += node.size
+            if node.content is not None and id(node.content) not in seen:
+                seen.add(id(node.content))
+                usage['resident'] += len(node.content)
+        return usage
+
+    def save_image(self, image_path: str) -> bool:
+        # Узлы пишутся в порядке обхода в ширину, поэтому родитель всегда раньше детей
+        self.ensure_subtree_loaded(self.root)
+        try:
+            started = time.perf_counter()
+            records = []
+            names = bytearray()
+            blob_offsets: Dict[int, int] = {} # при дедупликации общее содержимое пишется в образ один раз
+            with open(image_path, "wb") as file:
+                file.write(b'\0' * IMAGE_HEADER.size)
+                pending = deque([(self.root, IMAGE_NO_PARENT)])
+                while pending:
+                    node, parent_index = pending.popleft()
+                    index = len(records)
+                    name = node.vfs_name.encode('utf-8', 'surrogateescape')
+                    content_offset = file.tell()
+                    content_length = 0
+                    if node.is_directory:
+                        pending.extend((child, index) for _, child in self.iter_children(node))
+                    else:
+                        content = self.read_content(node)
+                        if content is not None:
+                            content_length = len(content)
+                            if self.blob_store is not None and id(content) in blob_offsets:
+                                content_offset = blob_offsets[id(content)]
+                            else:
+                                file.write(content)
+                                if self.blob_store is not None and isinstance(content, bytes):
+                                    blob_offsets[id(content)] = content_offset
+                    records.append(IMAGE_RECORD.pack(parent_index, len(names), len(name),
+                                                     IMAGE_FLAG_DIRECTORY if node.is_directory else 0,
+                                                     content_offset, content_length, node.mtime))
+                    names += name
+                names_offset = file.tell()
+                file.write(names)
+                table_offset = file.tell()
+                file.write(b''.join(records))
+                file.seek(0)
+                file.write(IMAGE_HEADER.pack(IMAGE_MAGIC, len(records), names_offset, table_offset))
+            elapsed = time.perf_counter() - started
+            self.out.line(f"Образ VFS сохранен в '{image_path}': {len(records)} объектов за {elapsed:.3f} с")
+            return True
+        except OSError as error:
+            self.out.line(f"Ошибка сохранения образа - {error}")
+            return False
+
+    def load_image(self, image_path: str) -> bool:
+        # Старт - одно открытие и одно отображение файла, содержимое читается срезами по требованию
+        try:
+            started = time.perf_counter()
+            image = VFSImage(image_path)
+            magic, count, names_offset, table_offset = IMAGE_HEADER.unpack_from(image.view)
+            if magic != IMAGE_MAGIC:
+                self.out.line(f"'{image_path}' не является образом VFS")
+                return False
+            names = image.view[names_offset:table_offset]
+            table = image.view[table_offset:table_offset + count * IMAGE_RECORD.size]
+            nodes: List[VFSNode] = []
+            for parent_index, name_offset, name_length, flags, offset, length, mtime in IMAGE_RECORD.iter_unpack(table):
+                name = str(names[name_offset:name_offset + name_length], 'utf-8', 'surrogateescape')
+                if parent_index == IMAGE_NO_PARENT:
+                    nodes.append(self.root)
+                    continue
+                parent = nodes[parent_index]
+                if flags & IMAGE_FLAG_DIRECTORY:
+                    node = VFSNode(name, is_directory=True, parent=parent, mtime=mtime)
+                else:
+                    node = VFSNode(name, is_directory=False, parent=parent, size=length, mtime=mtime,
+                                   source=ImageSource(image, offset, length))
+                self.attach(parent, node, propagate=False)
+                nodes.append(node)
+            for node in reversed(nodes[1:]): # родитель в образе всегда раньше детей
+                size, files, dirs = node.totals()
+                node.parent.subtree_bytes += size
+                node.parent.subtree_files += files
+                node.parent.subtree_dirs += dirs
+            self.load_state.entries_loaded = len(nodes) - 1
+            self.load_state.loaded = True
+            elapsed = time.perf_counter() - started
+            self.stats.load_time += elapsed
+            self.stats.load_entries += self.load_state.entries_loaded
+            self.out.line(f"VFS загружена из образа '{image_path}': {self.load_state.entries_loaded} объектов за {elapsed:.3f} с")
+            return True
+        except (OSError, ValueError, struct.error) as error:
+            self.out.line(f"Ошибка загрузки образа - {error}")
+            return False
+
+    def attach_scanned(self, node: VFSNode, disk_dir: str, entries: list) -> list:
+        with self.load_lock:
+            if node.scanned: # директорию уже успели загрузить по требованию
+                return self.scanned_subdirs(node, disk_dir)
+            if not node.is_inside(self.root): # поддерево удалили (rm) во время сканирования
+                return []
+            subdirs = self.attach_entries(node, disk_dir, entries)
+            node.scanned = True
+            self.load_state.dirs_scanned += 1
+            return subdirs
+
+    def scanned_subdirs(self, node: VFSNode, disk_dir: str) -> list:
+        # Снимок под load_lock: команды (rm, reload) меняют словари детей из другого потока
+        with self.load_lock:
+            return [(child, os.path.join(disk_dir, name)) for name, child in node.children.items()
+                    if child.is_directory]
+
+    def pending_scan(self, node: VFSNode) -> bool:
+        # Директорию еще нужно сканировать: она не загружена и не отсоединена от дерева.
+        # Отсоединенные узлы не доходят до корня - их дети попали бы в name_index после collect_detached
+        with self.load_lock:
+            return not node.scanned and node.is_inside(self.root)
+
+    def build_vfs_tree(self, vfs_node: VFSNode, disk_path: Path):
+        # Обход в ширину: директории сканируются в пуле потоков, узлы создаются под load_lock.
+        # Директории, которые уже загружены по требованию (ensure_loaded), повторно не сканируются,
+        # удаленные за время загрузки - пропускаются вместе с поддеревом
+        pending = deque([(vfs_node, str(disk_path))])
+        if self.load_workers <= 1:
+            while pending:
+                self.load_state.dirs_pending = len(pending)
+                node, path = pending.popleft()
+                if node.scanned:
+                    pending.extend(self.scanned_subdirs(node, path))
+                    continue
+                if not self.pending_scan(node):
+                    continue
+                try:
+                    entries = self.scan_directory(path)
+                except OSError as error:
+                    self.report_load_error(error)
+                    entries = []
+                pending.extend(self.attach_scanned(node, path, entries))
+            self.load_state.dirs_pending = 0
+            return
+        with ThreadPoolExecutor(max_workers=self.load_workers) as pool:
+            futures = {}
+            while pending or futures:
+                while pending:
+                    node, path = pending.popleft()
+                    if node.scanned:
+                        pending.extend(self.scanned_subdirs(node, path))
+                    elif self.pending_scan(node):
+                        futures[pool.submit(self.scan_directory, path)] = (node, path)
+                self.load_state.dirs_pending = len(futures)
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, path = futures.pop(future)
+                    try:
+                        entries = future.result()
+                    except OSError as error:
+                        self.report_load_error(error)
+                        entries = []
+                    pending.extend(self.attach_scanned(node, path, entries))
+        self.load_state.dirs_pending = 0
+
+class CommandSpec:
+    # Описание команды в реестре: обработчик и ограничения на аргументы
+    def __init__(self, name: str, handler, min_args: int = 0, max_args: Optional[int] = None,
+                 missing: str = '', usage: str = '', flags: str = '', mutating: bool = False,
+                 globs: bool = False, glob_skip: int = 0, host_access: bool = False):
+        self.name = name
+        self.handler = handler # вызывается как handler(args)
+        self.min_args = min_args
+        self.max_args = max_args
+        self.missing = missing # что сообщить, если аргументов меньше min_args
+        self.usage = usage
+        self.flags = flags # допустимые однобуквенные флаги
+        self.mutating = mutating # команда изменяет дерево VFS
+        self.globs = globs # аргументы-пути раскрываются по шаблонам (*, ?, [...])
+        self.glob_skip = glob_skip # сколько первых позиционных аргументов - не пути (например, шаблон grep)
+        self.host_access = host_access # команда читает произвольные файлы хоста (вне VFS)
+
+class ScriptCommand:
+    # Строка скрипта, разобранная один раз - такой скрипт можно выполнять многократно
+    __slots__ = ('line_number', 'name', 'args', 'spec')
+
+    def __init__(self, line_number: int, name: str, args: List[str], spec: Optional[CommandSpec]):
+        self.line_number = line_number
+        self.name = name
+        self.args = args
+        self.spec = spec
 
 class VFSRepl:
 
-    def __init__(self, vfs_name='myVFS', path=None, start_script=None):
+    def __init__(self, vfs_name='myVFS', path=None, start_script=None, lazy=False, cache_size=DEFAULT_CACHE_SIZE,
+                 mmap_threshold=DEFAULT_MMAP_THRESHOLD, load_workers=DEFAULT_LOAD_WORKERS,
+                 image=None, save_image=None, dedup=False, background=False, cow=False, journal=None,
+                 grep_workers=DEFAULT_GREP_WORKERS, vfs=None, out=None):
+        self.out = out or OutputSink()
         self.vfs_name = vfs_name
         self.path = path
         self.start_script = start_script
         self.running = True
-        self.vfs = VFS()
+        self.commands: Dict[str, CommandSpec] = {}
+        self.compiled_scripts: Dict[str, tuple] = {} # путь -> (mtime, список ScriptCommand)
+        self.register_builtin_commands()
+        if vfs is not None: # сессия над уже загруженной VFS (режим сервера)
+            self.vfs = vfs
+            return
+        self.vfs = VFS(lazy=lazy, cache_size=cache_size, mmap_threshold=mmap_threshold, load_workers=load_workers,
+                       dedup=dedup, cow=cow, grep_workers=grep_workers, out=self.out)
         
-        print(f"\nКонфигурация VFS")
-        print(f"Имя VFS: {vfs_name}")
-        print(f"Физический путь: {path}")
-        print(f"Стартовый скрипт: {start_script or 'Не указан'}")
+        self.out.line(f"\nКонфигурация VFS")
+        self.out.line(f"Имя VFS: {vfs_name}")
+        self.out.line(f"Физический путь: {path}")
+        self.out.line(f"Стартовый скрипт: {start_script or 'Не указан'}")
+        self.out.line(f"Ленивая загрузка: {'да' if lazy else 'нет'}")
+        self.out.line(f"Потоков загрузки: {load_workers}")
+        self.out.line(f"Образ VFS: {image or 'Не указан'}")
+        self.out.line(f"Дедупликация содержимого: {'да' if dedup else 'нет'}")
+        self.out.line(f"Слой изменений (copy-on-write): {'да' if cow else 'нет'}")
+        self.out.line(f"Журнал изменений: {journal or 'Не указан'}")
 
-        if path:
-            self.vfs.load_from_disk(path)
+        if image:
+            self.vfs.load_image(image)
+        elif path:
+            self.vfs.load_from_disk(path, background=background)
+        if journal:
+            self.vfs.open_journal(journal)
+        if save_image and (self.vfs.load_state.loaded or self.vfs.load_state.loading):
+            # При фоновой загрузке save_image сам догружает дерево; под load_lock загрузчик его не меняет
+            with self.vfs.load_lock:
+                self.vfs.save_image(save_image)
+        self.out.flush()
     
+    def register_command(self, name: str, handler, **spec_args) -> CommandSpec:
+        # Точка расширения: новые команды добавляются в реестр, а не в цепочку if/elif
+        spec = CommandSpec(name, handler, **spec_args)
+        self.commands[name] = spec
+        return spec
+
+    def register_builtin_commands(self):
+        self.register_command('ls', self.cmd_ls, usage='ls [путь ...]', globs=True)
+        self.register_command('cd', self.cmd_cd, max_args=1, usage='cd [директория]', globs=True)
+        self.register_command('pwd', self.cmd_pwd, usage='pwd')
+        self.register_command('uniq', self.cmd_uniq, min_args=1, missing='файл',
+                              usage='uniq [-c] [-d] [-u] файл', flags='cdu', globs=True)
+        self.register_command('head', self.cmd_head, min_args=1, missing='файл',
+                              usage='head [-n N] файл ...', globs=True)
+        self.register_command('tail', self.cmd_tail, min_args=1, missing='файл',
+                              usage='tail [-n N] файл ...', globs=True)
+        self.register_command('wc', self.cmd_wc, min_args=1, missing='файл',
+                              usage='wc [-l] [-w] [-c] файл ...', flags='lwc', globs=True)
+        self.register_command('sed', self.cmd_sed, min_args=3, missing="-n 'N[,M]p' и файл",
+                              usage="sed -n 'N[,M]p' файл ...", globs=True, glob_skip=1)
+        self.register_command('whoami', self.cmd_whoami, usage='whoami')
+        self.register_command('exit', self.cmd_exit, usage='exit')
+        self.register_command('rm', self.cmd_rm, min_args=1, missing='файл или директорию',
+                              usage='rm [-r] цель ...', flags='rR', globs=True)
+        self.register_command('reload', self.cmd_reload, max_args=0, usage='reload', mutating=True)
+        self.register_command('snapshot', self.cmd_snapshot, max_args=0, usage='snapshot')
+        self.register_command('rollback', self.cmd_rollback, max_args=1, usage='rollback [номер снимка]')
+        self.register_command('commit', self.cmd_commit, max_args=0, usage='commit', mutating=True)
+        self.register_command('find', self.cmd_find, usage='find [путь] [-name шаблон] [-type f|d]')
+        self.register_command('grep', self.cmd_grep, min_args=1, missing='шаблон',
+                              usage='grep [-r] [-c] [-l] шаблон путь ...', flags='rcl', globs=True, glob_skip=1)
+        self.register_command('du', self.cmd_du, max_args=2, usage='du [-m] [путь]', flags='m', globs=True)
+        self.register_command('count', self.cmd_count, max_args=1, usage='count [путь]', globs=True)
+        self.register_command('stats', self.cmd_stats, max_args=0, usage='stats')
+        self.register_command('status', self.cmd_status, max_args=0, usage='status')
+        self.register_command('source', self.cmd_source, min_args=1, max_args=1, missing='файл скрипта',
+                              usage='source файл', host_access=True)
+
     def print_prompt(self):
         current_path = self.vfs.current_dir.get_path()
-        print(f"\n{self.vfs_name}:{current_path}$ ", end="")
+        self.out.write(f"\n{self.vfs_name}:{current_path}$ ")
+        self.out.flush() # приглашение - точка сброса буфера перед ожиданием ввода
     
     def parse_input(self, user_input):
         input_line = user_input.strip() #убираем лишние знаки табуляции в начале и конце строки
@@ -128,233 +1670,659 @@ class VFSRepl:
             for arg in args:
                 target_node = self.vfs.find_node(arg)
                 if not target_node:
-                    print(f"ls: {arg}: No such file or directory")
+                    self.out.line(f"ls: {arg}: No such file or directory")
                 elif target_node.is_directory:
                     # Показать содержимое директории
-                    if not target_node.children:
-                        print(f"Директория '{arg}' пуста")
-                    else:
-                        for name, node in sorted(target_node.children.items()):
-                            file_type = "d" if node.is_directory else "f"
-                            print(f"{file_type} {name}")
+                    self.vfs.ensure_loaded(target_node)
+                    empty = True
+                    for name, node in self.vfs.iter_children(target_node):
+                        empty = False
+                        file_type = "d" if node.is_directory else "f"
+                        self.out.line(f"{file_type} {name}")
+                    if empty:
+                        self.out.line(f"Директория '{arg}' пуста")
                 else:
                     # Показать только этот файл
-                    print(f"f {arg}")
+                    self.out.line(f"f {arg}")
         else:
             # Базовый случай - показать текущую директорию
             target_dir = self.vfs.current_dir
-            if not target_dir.children:
-                print("Директория пуста")
-            else:
-                for name, node in sorted(target_dir.children.items()):
-                    file_type = "d" if node.is_directory else "f"
-                    print(f"{file_type} {name}")
+            self.vfs.ensure_loaded(target_dir)
+            empty = True
+            for name, node in self.vfs.iter_children(target_dir):
+                empty = False
+                file_type = "d" if node.is_directory else "f"
+                self.out.line(f"{file_type} {name}")
+            if empty:
+                self.out.line("Директория пуста")
 
     def cmd_cd(self, args):
         if not args:
             self.vfs.current_dir = self.vfs.root
             return
         
-        if len(args) > 1:
-            print("cd: слишком много аргументов")
-            print("использование: cd [директория]")
-            return
-    
         target_path = args[0]
 
         if target_path == "..":
             if self.vfs.current_dir.parent:
                 self.vfs.current_dir = self.vfs.current_dir.parent
             else:
-                print("cd: уже в корневой директории") 
+                self.out.line("cd: уже в корневой директории") 
             return
         
         if target_path == "/":
             self.vfs.current_dir = self.vfs.root
             return
         
-        if target_path in self.vfs.current_dir.children:
-            target_node = self.vfs.current_dir.children[target_path]
+        self.vfs.ensure_loaded(self.vfs.current_dir)
+        target_node = self.vfs.child(self.vfs.current_dir, target_path)
+        if target_node is not None:
             if target_node.is_directory:
                 self.vfs.current_dir = target_node
             else:
-                print(f"cd: {target_path}: не является директорией")
+                self.out.line(f"cd: {target_path}: не является директорией")
         else:
-            print(f"cd: {target_path}: директория не найдена")
+            self.out.line(f"cd: {target_path}: директория не найдена")
 
     def cmd_exit(self, args):
-        print(f"Команда: exit")
-        print(f"Аргументы: {args}")
-        print("Завершение работы VFS")
+        self.out.line(f"Команда: exit")
+        self.out.line(f"Аргументы: {args}")
+        self.out.line("Завершение работы VFS")
         self.running = False
     
-    def cmd_pwd(self):
-        print(self.vfs.current_dir.get_path())
+    def cmd_pwd(self, args=None):
+        self.out.line(self.vfs.current_dir.get_path())
 
-    def cmd_whoami(self):
-        print(getpass.getuser()) #встроенная функция, возвращает имя текущего пользователя системы
+    def cmd_whoami(self, args=None):
+        self.out.line(getpass.getuser()) #встроенная функция, возвращает имя текущего пользователя системы
 
     def cmd_uniq(self, args):
-        if not args:
-            print("uniq: требуется указать файл")
+        flags, targets = split_flags(args)
+        if not targets:
+            self.out.line("uniq: требуется указать файл")
             return
-        filename = args[0]
+        filename = targets[0]
 
         target_node = self.vfs.find_node(filename)
 
         if not target_node:
-            print(f"uniq: {filename}: файл не найден")
+            self.out.line(f"uniq: {filename}: файл не найден")
             return
     
         if target_node.is_directory:
-            print(f"uniq: {filename}: является директорией")
+            self.out.line(f"uniq: {filename}: является директорией")
             return
 
-        if target_node.content is None or len(target_node.content) == 0:
-            print(f"uniq: {filename}: файл пуст")
+        raw_content = self.vfs.read_content(target_node)
+        if raw_content is None or len(raw_content) == 0:
+            self.out.line(f"uniq: {filename}: файл пуст")
             return
 
-        try:
-            content = target_node.content.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                content = target_node.content.decode('latin-1')
-            except UnicodeDecodeError:
-                print(f"uniq: {filename}: не текстовый файл")
-                return
+        # Строки читаются прямо из буфера (в т.ч. отображенного через mmap), без копии всего файла
+        # и без индекса строк - память не зависит от числа строк
+        if not flags:
+            seen_lines = set()
+            for line in iter_lines(raw_content):
+                digest = line_digest(line)
+                if digest not in seen_lines:
+                    seen_lines.add(digest)
+                    self.out.line(decode_line(line))
+            return
 
+        # -c/-d/-u требуют количества: первый проход считает, второй печатает в порядке первого появления
+        counts: Dict[bytes, int] = {}
+        for line in iter_lines(raw_content):
+            digest = line_digest(line)
+            counts[digest] = counts.get(digest, 0) + 1
 
-        content = content.replace('\r\n', '\n').replace('\r', '\n')
-        lines = content.split('\n')
+        for line in iter_lines(raw_content):
+            count = counts.pop(line_digest(line), None)
+            if count is None: # строка уже выведена
+                continue
+            if ('d' in flags and count == 1) or ('u' in flags and count > 1):
+                continue
+            if 'c' in flags:
+                self.out.line(f"{count:7d} {decode_line(line)}")
+            else:
+                self.out.line(decode_line(line))
 
-        if lines and lines[-1] == '':
-            lines = lines[:-1]
+    def text_file(self, command: str, path: str) -> Optional[VFSNode]:
+        node = self.vfs.find_node(path)
+        if not node:
+            self.out.line(f"{command}: {path}: файл не найден")
+            return None
+        if node.is_directory:
+            self.out.line(f"{command}: {path}: является директорией")
+            return None
+        return node
 
-        unique_lines = []
-        seen_lines = set()
-        
-        for line in lines:
-            if line not in seen_lines:
-                unique_lines.append(line)
-                seen_lines.add(line)
-        
-        for line in unique_lines:
-            print(line)
+    def print_lines(self, command: str, args, select):
+        # Общая часть head и tail: разбор -n N и вывод выбранных строк каждого файла.
+        # select(число строк в файле, N) -> (первая строка, строка после последней)
+        count = DEFAULT_HEAD_LINES
+        files = []
+        position = 0
+        while position < len(args):
+            arg = args[position]
+            if arg.startswith('-n'):
+                # -n N или слитно -nN
+                if arg == '-n':
+                    value = args[position + 1] if position + 1 < len(args) else ''
+                    position += 2
+                else:
+                    value = arg[2:]
+                    position += 1
+                if not value.isdigit():
+                    self.out.line(f"{command}: неверное число строк: '{value}'")
+                    return
+                count = int(value)
+                continue
+            files.append(arg)
+            position += 1
+        if not files:
+            self.out.line(f"{command}: требуется указать файл")
+            return
+        for index, path in enumerate(files):
+            node = self.text_file(command, path)
+            if node is None:
+                continue
+            if len(files) > 1:
+                self.out.line(f"{'' if index == 0 else chr(10)}==> {path} <==")
+            view = self.vfs.text_view(node)
+            first, last = select(view.line_count, count)
+            for line in self.vfs.text_lines(node, view, first, last):
+                self.out.line(line)
+
+    def cmd_head(self, args):
+        self.print_lines('head', args, lambda total, count: (0, count))
+
+    def cmd_tail(self, args):
+        self.print_lines('tail', args, lambda total, count: (total - count, total))
+
+    def cmd_sed(self, args):
+        # Поддерживается только печать диапазона строк: sed -n 'Np', 'N,Mp', '$p', 'N,$p'
+        if args[0] != '-n':
+            self.out.line("sed: поддерживается только режим -n")
+            self.out.line(f"использование: {self.commands['sed'].usage}")
+            return
+        script = args[1].strip('\'"')
+        match = re.fullmatch(r'(\d+|\$)(?:,(\d+|\$))?p', script)
+        if not match or match.group(1) == '0':
+            self.out.line(f"sed: неверная команда: '{args[1]}'")
+            return
+        for path in args[2:]:
+            node = self.text_file('sed', path)
+            if node is None:
+                continue
+            view = self.vfs.text_view(node)
+            total = view.line_count
+            first = total if match.group(1) == '$' else int(match.group(1))
+            last = match.group(2) or match.group(1)
+            last = total if last == '$' else int(last)
+            for line in self.vfs.text_lines(node, view, first - 1, max(last, first)):
+                self.out.line(line)
+
+    def cmd_wc(self, args):
+        flags, files = split_flags(args)
+        if not files:
+            self.out.line("wc: требуется указать файл")
+            return
+        flags = flags or set('lwc')
+        totals = [0, 0, 0]
+        for path in files:
+            node = self.text_file('wc', path)
+            if node is None:
+                continue
+            # Число строк и байт известно из TextView и метаданных, слова считаются только по запросу
+            view = self.vfs.text_view(node)
+            words = view.count_words(self.vfs.read_content(node) or b'') if 'w' in flags else 0
+            counts = [view.line_count, words, node.size]
+            totals = [total + value for total, value in zip(totals, counts)]
+            self.out.line(self.format_wc(counts, flags) + f" {path}")
+        if len(files) > 1:
+            self.out.line(self.format_wc(totals, flags) + " итого")
+
+    def format_wc(self, counts, flags) -> str:
+        return ''.join(f"{value:8}" for flag, value in zip('lwc', counts) if flag in flags)
 
     def cmd_rm(self, args):
         if not args:
-            print("rm: требуется указать файл или директорию")
+            self.out.line("rm: требуется указать файл или директорию")
             return
         
-        recursive = False 
-        targets = []
-        
-        for arg in args: #проверяем флаги
-            if arg == '-r' or arg == '-R':
-                recursive = True
-            else:
-                targets.append(arg)
+        flags, targets = split_flags(args)
+        recursive = bool(flags) # допустимы только -r и -R
         
         if not targets:
-            print("rm: требуется указать файл или директорию")
+            self.out.line("rm: требуется указать файл или директорию")
             return
         
         for target in targets:
-            if self.vfs.find_node(target):
-                target_node = self.vfs.find_node(target)
-                
-                if target_node.is_directory:
-                    if not recursive:
-                        print(f"rm: {target}: является директорией (используйте -r для рекурсивного удаления)")
-                        continue
-                    
-                    # Рекурсивное удаление директории
-                    if not self.remove_directory(target_node):
-                        print(f"rm: не удалось удалить директорию '{target}'")
-                        continue
-                
-                # Удаление файла или уже очищенной директории
-                parent = target_node.parent
-                if parent and parent.remove_child(target_node.vfs_name):
-                    print(f"Удалено: {target}")
-                else:
-                    print(f"rm: не удалось удалить '{target}'")
+            target_node = self.vfs.find_node(target)
+            if not target_node:
+                self.out.line(f"rm: {target}: файл или директория не найдена")
+                continue
+
+            if target_node.is_directory and not recursive:
+                self.out.line(f"rm: {target}: является директорией (используйте -r для рекурсивного удаления)")
+                continue
+
+            # Директория удаляется вместе с поддеревом одним отсоединением (или скрывается в слое
+            # изменений), очистка узлов отложена
+            if self.vfs.detach(target_node):
+                self.out.line(f"Удалено: {target}")
             else:
-                print(f"rm: {target}: файл или директория не найдена")
+                self.out.line(f"rm: не удалось удалить '{target}'")
 
-    def remove_directory(self, dir_node: VFSNode) -> bool:
+    def cmd_find(self, args):
+        start_path = '.'
+        pattern = None
+        node_type = None
+        position = 0
+        if args and not args[0].startswith('-'):
+            start_path = args[0]
+            position = 1
+        while position < len(args):
+            option = args[position]
+            value = args[position + 1] if position + 1 < len(args) else None
+            if option == '-name' and value is not None:
+                pattern = value
+            elif option == '-type' and value in ('f', 'd'):
+                node_type = value
+            else:
+                self.out.line(f"find: неверный параметр '{option}'")
+                self.out.line(f"использование: {self.commands['find'].usage}")
+                return
+            position += 2
+
+        start = self.vfs.find_node(start_path)
+        if not start:
+            self.out.line(f"find: {start_path}: файл или директория не найдена")
+            return
+        for node in self.vfs.find(start, pattern, node_type):
+            self.out.line(node.get_path())
+
+    def cmd_grep(self, args):
+        flags, positional = split_flags(args)
+        if not positional:
+            self.out.line("grep: требуется указать шаблон")
+            return
+        recursive = 'r' in flags
+        paths = positional[1:] or (['.'] if recursive else [])
+        if not paths:
+            self.out.line("grep: требуется указать файл")
+            return
+        pattern = positional[0].encode('utf-8', 'surrogateescape')
         try:
-            for child_name, child_node in list(dir_node.children.items()):
-                if child_node.is_directory:
-                    if not self.remove_directory(child_node):
-                        return False
-                if not dir_node.remove_child(child_name):
-                    return False
-            return True 
-        except Exception as e:
-            print(f"Ошибка при удалении директории: {e}")
-            return False
+            re.compile(pattern)
+        except re.error as error:
+            self.out.line(f"grep: неверный шаблон: {error}")
+            return
 
-    def handle_command(self, command, args):
-        if command == "ls":
-            self.cmd_ls(args)
-        elif command == "cd":
-            self.cmd_cd(args)
-        elif command == "pwd":
-            self.cmd_pwd()
-        elif command == "uniq":
-            self.cmd_uniq(args)
-        elif command == "whoami":
-            self.cmd_whoami()
-        elif command == "exit":
-            self.cmd_exit(args)
-        elif command == "rm":
-            self.cmd_rm(args)   
+        names = []
+        nodes = []
+        for path in paths:
+            node = self.vfs.find_node(path)
+            if not node:
+                self.out.line(f"grep: {path}: файл или директория не найдена")
+            elif not node.is_directory:
+                names.append(path)
+                nodes.append(node)
+            elif not recursive:
+                self.out.line(f"grep: {path}: является директорией")
+            else:
+                self.vfs.ensure_subtree_loaded(node)
+                files = sorted((child for child in self.vfs.walk(node) if not child.is_directory),
+                               key=lambda child: child.get_path())
+                names.extend(child.get_path() for child in files)
+                nodes.extend(files)
+
+        mode = 'files' if 'l' in flags else 'count' if 'c' in flags else 'lines'
+        show_names = recursive or len(paths) > 1
+        for name, result in zip(names, self.vfs.grep(pattern, nodes, mode)):
+            if mode == 'files':
+                if result:
+                    self.out.line(name)
+            elif mode == 'count':
+                self.out.line(f"{name}:{result}" if show_names else str(result))
+            else:
+                for line in result:
+                    text = decode_line(line.rstrip(b'\r'))
+                    self.out.line(f"{name}:{text}" if show_names else text)
+
+    def cmd_du(self, args):
+        # Размер и число объектов берутся из агрегатов узла; обход поддерева нужен только для -m
+        flags, paths = split_flags(args)
+        if len(paths) > 1:
+            self.out.line(f"использование: {self.commands['du'].usage}")
+            return
+        target_path = paths[0] if paths else '.'
+        target_node = self.vfs.find_node(target_path)
+        if not target_node:
+            self.out.line(f"du: {target_path}: файл или директория не найдена")
+            return
+        size, files, dirs = self.vfs.subtree_totals(target_node)
+        self.out.line(f"Файлов: {files}, директорий: {dirs}")
+        self.out.line(f"Логический размер: {size} байт")
+        if 'm' in flags:
+            usage = self.vfs.disk_usage(target_node)
+            self.out.line(f"Резидентный размер (в памяти, с дедупликацией): {usage['resident']} байт")
+
+    def cmd_count(self, args):
+        target_path = args[0] if args else '.'
+        target_node = self.vfs.find_node(target_path)
+        if not target_node:
+            self.out.line(f"count: {target_path}: файл или директория не найдена")
+            return
+        _, files, dirs = self.vfs.subtree_totals(target_node)
+        if target_node.is_directory:
+            dirs -= 1 # сама директория не считается
+        self.out.line(f"Файлов: {files}, директорий: {dirs}, всего: {files + dirs}")
+
+    def cmd_stats(self, args):
+        stats = self.vfs.stats
+        labels = [f"<{bound * 1000:g}мс" for bound in LATENCY_BUCKETS] + [f">={LATENCY_BUCKETS[-1] * 1000:g}мс"]
+        self.out.line(f"{'команда':10} {'вызовов':>8} {'всего, мс':>11} {'среднее, мс':>12}  "
+                      + ' '.join(f"{label:>9}" for label in labels))
+        for command, command_stats in sorted(stats.commands.items()):
+            average = command_stats.total_time / command_stats.calls
+            self.out.line(f"{command:10} {command_stats.calls:8} {command_stats.total_time * 1000:11.3f} "
+                          f"{average * 1000:12.3f}  " + ' '.join(f"{count:9}" for count in command_stats.histogram))
+        self.out.line(f"Загрузка: {stats.load_entries} объектов за {stats.load_time:.3f} с")
+        self.out.line(f"Прочитано с диска/из источников: {stats.bytes_read} байт")
+        self.out.line(f"find_node: вызовов {stats.find_calls}, попаданий в кэш {stats.find_cache_hits}, "
+                      f"пройдено компонентов пути {stats.nodes_visited}")
+
+    def cmd_status(self, args):
+        vfs = self.vfs
+        if vfs.load_state.loading:
+            elapsed = time.perf_counter() - vfs.load_state.load_started
+            self.out.line("Загрузка: идет в фоне")
         else:
-            print(f"{command}: команда не найдена")
-    
+            elapsed = vfs.load_state.load_elapsed
+            self.out.line(f"Загрузка: {'завершена' if vfs.load_state.loaded else 'не выполнялась'}")
+        rate = vfs.load_state.entries_loaded / elapsed if elapsed > 0 else 0
+        self.out.line(f"Директорий просканировано: {vfs.load_state.dirs_scanned}, в очереди: {vfs.load_state.dirs_pending}")
+        self.out.line(f"Загружено объектов: {vfs.load_state.entries_loaded} за {elapsed:.3f} с ({rate:.0f} объектов/с)")
+        for error in vfs.load_state.load_errors:
+            self.out.line(f"Ошибка загрузки - {error}")
+        if vfs.journal is not None:
+            self.out.line(f"Журнал: {vfs.journal.records} записей в файле, {len(vfs.journal.pending)} в очереди")
+        if vfs.overlay is not None:
+            self.out.line(f"Слой изменений: скрыто узлов {len(vfs.overlay.hidden)}, "
+                          f"снимков {len(vfs.overlay.snapshots)}")
+
+    def cmd_reload(self, args):
+        if self.vfs.overlay is not None and self.vfs.overlay.log:
+            self.out.line("reload: есть незафиксированные изменения (используйте commit или rollback)")
+            return
+        started = time.perf_counter()
+        changes = self.vfs.reload_from_disk()
+        if changes is None:
+            self.out.line("reload: VFS не загружена с диска")
+            return
+        elapsed = time.perf_counter() - started
+        self.out.line(f"Обновлено за {elapsed:.3f} с: добавлено {changes['added']}, "
+              f"удалено {changes['removed']}, изменено {changes['updated']}")
+
+    def cmd_snapshot(self, args):
+        if self.vfs.overlay is None:
+            self.out.line("snapshot: слой изменений выключен (запустите с --cow)")
+            return
+        number = self.vfs.snapshot()
+        self.out.line(f"Снимок {number}: изменений в слое {len(self.vfs.overlay.log)}")
+
+    def cmd_rollback(self, args):
+        overlay = self.vfs.overlay
+        if overlay is None:
+            self.out.line("rollback: слой изменений выключен (запустите с --cow)")
+            return
+        number = None
+        if args:
+            if not args[0].isdigit() or not 0 <= int(args[0]) <= len(overlay.snapshots):
+                self.out.line(f"rollback: {args[0]}: нет такого снимка")
+                return
+            number = int(args[0])
+        undone = self.vfs.rollback(number)
+        self.out.line(f"Отменено изменений: {undone}, снимков осталось: {len(overlay.snapshots)}")
+
+    def cmd_commit(self, args):
+        if self.vfs.overlay is None:
+            self.out.line("commit: слой изменений выключен (запустите с --cow)")
+            return
+        applied = self.vfs.commit_overlay()
+        self.out.line(f"Зафиксировано изменений: {applied}")
+
+    def handle_command(self, command, args):
+        self.dispatch(self.commands.get(command), command, args)
+
+    def expand_args(self, args: List[str], skip: int = 0) -> List[str]:
+        # Раскрытие шаблонов выполняется при каждом запуске команды (дерево между запусками меняется),
+        # флаги и первые skip позиционных аргументов не раскрываются, шаблон без совпадений остается как есть
+        count = flag_count(args)
+        expanded = args[:count]
+        for arg in args[count:]:
+            if skip > 0:
+                skip -= 1
+                expanded.append(arg)
+            elif not any(char in arg for char in '*?['):
+                expanded.append(arg)
+            else:
+                expanded.extend(self.vfs.glob(arg) or [arg])
+        return expanded
+
+    def dispatch(self, spec: Optional[CommandSpec], command, args):
+        if spec is None:
+            self.out.line(f"{command}: команда не найдена")
+            return
+        if spec.globs:
+            with self.vfs.load_lock:
+                args = self.expand_args(args, spec.glob_skip)
+        if len(args) < spec.min_args:
+            self.out.line(f"{command}: требуется указать {spec.missing}")
+            return
+        if spec.max_args is not None and len(args) > spec.max_args:
+            self.out.line(f"{command}: слишком много аргументов")
+            self.out.line(f"использование: {spec.usage}")
+            return
+        if spec.flags:
+            # Проверяется только ведущая серия флагов - та же, что разбирает split_flags
+            unknown = split_flags(args)[0] - set(spec.flags)
+            if unknown:
+                self.out.line(f"{command}: неизвестный флаг -{''.join(sorted(unknown))}")
+                self.out.line(f"использование: {spec.usage}")
+                return
+        if spec.mutating and self.vfs.read_only:
+            self.out.line(f"{command}: VFS доступна только для чтения")
+            return
+        if spec.host_access and self.vfs.read_only: # сессии сервера не получают доступа к файлам хоста
+            self.out.line(f"{command}: недоступно в сессии сервера")
+            return
+        with self.vfs.load_lock: # фоновый загрузчик и другие сессии не меняют дерево во время команды
+            started = time.perf_counter()
+            try:
+                spec.handler(args)
+            finally:
+                self.vfs.stats.record_command(command, time.perf_counter() - started)
+
+    def compile_script(self, script_path: str) -> List[ScriptCommand]:
+        # Разбор выполняется один раз на версию файла; повторный запуск берет готовый список
+        mtime = os.path.getmtime(script_path)
+        cached = self.compiled_scripts.get(script_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        compiled = []
+        with open(script_path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                command, args = self.parse_input(line)
+                if command:
+                    compiled.append(ScriptCommand(line_number, command, args, self.commands.get(command)))
+        self.compiled_scripts[script_path] = (mtime, compiled)
+        return compiled
+
+    def run_script(self, compiled: List[ScriptCommand]):
+        for script_command in compiled:
+            # Команда могла быть зарегистрирована уже после разбора скрипта
+            spec = script_command.spec or self.commands.get(script_command.name)
+            self.dispatch(spec, script_command.name, script_command.args)
+
     def run_start_script(self):
         if self.start_script and os.path.exists(self.start_script):
             try:
-                print(f"Выполнение стартового скрипта: {self.start_script}")
-                with open(self.start_script, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line and not line.startswith('#'):
-                            command, args = self.parse_input(line)
-                            if command:
-                                self.handle_command(command, args)
+                self.out.line(f"Выполнение стартового скрипта: {self.start_script}")
+                self.run_script(self.compile_script(self.start_script))
             except Exception as e:
-                print(f"Ошибка выполнения стартового скрипта: {e}")
+                self.out.line(f"Ошибка выполнения стартового скрипта: {e}")
+
+    def cmd_source(self, args):
+        script_path = args[0]
+        if not os.path.exists(script_path):
+            self.out.line(f"source: {script_path}: файл не найден")
+            return
+        self.run_script(self.compile_script(script_path))
 
     def run(self):
         self.run_start_script()
         while self.running: 
             try:
                 self.print_prompt()
+                with self.vfs.load_lock: # очистка удаленных узлов, пока пользователь набирает команду
+                    self.vfs.collect_detached()
+                    self.vfs.flush_journal() # пачка записей журнала - на диск перед ожиданием ввода
                 user_input = input()
                 command, args = self.parse_input(user_input)
                 
                 if command:
                     self.handle_command(command, args)
             except Exception as e:
-                print(f"Ошибка: {e}. Продолжаем работу")
+                self.out.line(f"Ошибка: {e}. Продолжаем работу")
+        self.vfs.close_journal()
+        self.out.flush()
+
+class SessionStream:
+    # Поток вывода сессии сервера: команда выполняется в рабочем потоке,
+    # а запись в сокет передается в цикл событий
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter):
+        self.loop = loop
+        self.writer = writer
+        self.loop_thread = threading.get_ident() # создается в потоке цикла событий
+
+    def write(self, text: str):
+        if threading.get_ident() == self.loop_thread:
+            self.writer.write(text.encode('utf-8'))
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, text.encode('utf-8'))
+
+    def flush(self):
+        pass
+
+class VFSServer:
+    # Одна загруженная VFS обслуживает много сессий REPL через сокет (TCP host:port или Unix-сокет)
+    def __init__(self, repl: VFSRepl):
+        self.repl = repl
+        self.sessions = 0
+
+    async def handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        out = OutputSink(SessionStream(loop, writer))
+        session = VFSRepl(self.repl.vfs_name, vfs=self.repl.vfs.fork_session(out), out=out)
+        self.sessions += 1
+        try:
+            while session.running:
+                session.print_prompt()
+                await writer.drain()
+                line = await reader.readline()
+                if not line:
+                    break
+                command, args = session.parse_input(line.decode('utf-8', 'replace'))
+                if not command:
+                    continue
+                try:
+                    await loop.run_in_executor(None, session.handle_command, command, args)
+                except Exception as e:
+                    out.line(f"Ошибка: {e}. Продолжаем работу")
+            out.flush()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def serve(self, address: str):
+        host, _, port = address.rpartition(':')
+        if host and port.isdigit():
+            server = await asyncio.start_server(self.handle_session, host, int(port))
+        else:
+            server = await asyncio.start_unix_server(self.handle_session, path=address)
+        self.repl.out.line(f"Сервер VFS '{self.repl.vfs_name}' принимает сессии на {address}")
+        self.repl.out.flush()
+        async with server:
+            await server.serve_forever()
 
 def parse_args():
         parser = argparse.ArgumentParser()
         parser.add_argument('--path', help='Путь к физическому расположению VFS', default=os.getcwd())
         parser.add_argument('--prompt', help='Пользовательское приглашение к вводу', default='myVFS')
         parser.add_argument('--script', help='Путь к стартовому скрипту')
+        parser.add_argument('--lazy', action='store_true', help='Читать содержимое файлов только по требованию')
+        parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                            help='Размер кэша содержимого в ленивом режиме (МБ)')
+        parser.add_argument('--mmap-threshold', type=int, default=DEFAULT_MMAP_THRESHOLD // (1024 * 1024),
+                            help='Файлы от этого размера (МБ) отображаются в память через mmap, 0 - отключить')
+        parser.add_argument('--load-workers', type=int, default=DEFAULT_LOAD_WORKERS,
+                            help='Число потоков для параллельного сканирования директорий')
+        parser.add_argument('--grep-workers', type=int, default=DEFAULT_GREP_WORKERS,
+                            help='Число процессов для grep по большим поддеревьям (1 - без пула)')
+        parser.add_argument('--dedup', action='store_true',
+                            help='Хранить одинаковое содержимое файлов в памяти один раз')
+        parser.add_argument('--profile', help='Профилировать сессию через cProfile и сохранить результат в файл')
+        parser.add_argument('--background', action='store_true',
+                            help='Загружать VFS в фоне, не дожидаясь конца загрузки для приглашения')
+        parser.add_argument('--serve', help='Режим сервера: обслуживать сессии на host:port или Unix-сокете')
+        parser.add_argument('--cow', action='store_true',
+                            help='Изменения (rm) попадают в слой copy-on-write: snapshot, rollback, commit')
+        parser.add_argument('--journal', help='Файл журнала изменений: применяется при запуске, дописывается в работе')
+        parser.add_argument('--image', help='Загрузить VFS из готового образа (вместо --path)')
+        parser.add_argument('--save-image', help='Сохранить загруженную VFS в файл образа')
         return parser.parse_args()
 
 def main():
     args = parse_args()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
     
     vfs = VFSRepl(vfs_name=args.prompt, 
                  path=args.path,
-                 start_script=args.script)
+                 start_script=args.script,
+                 lazy=args.lazy,
+                 cache_size=args.cache_size * 1024 * 1024,
+                 mmap_threshold=args.mmap_threshold * 1024 * 1024,
+                 load_workers=args.load_workers,
+                 grep_workers=args.grep_workers,
+                 image=args.image,
+                 save_image=args.save_image,
+                 dedup=args.dedup,
+                 background=args.background,
+                 cow=args.cow,
+                 journal=args.journal)
     
-    vfs.run()
+    try:
+        if args.serve:
+            try:
+                asyncio.run(VFSServer(vfs).serve(args.serve))
+            except KeyboardInterrupt: # остановка сервера по Ctrl+C
+                pass
+        else:
+            vfs.run()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"\nПрофиль сохранен в '{args.profile}'")
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
 
 if __name__ == "__main__":
     main()